@@ -0,0 +1,88 @@
+"""
+Time the candidate endpoints with the actor index and with the
+database alone.
+
+python benchmarks/bench_actor_index.py [number of actors]
+"""
+
+import sys
+import os
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskr import create_app  # noqa: E402
+from flaskr.matching import ActorIndex  # noqa: E402
+from flaskr.models import Actor, Movie, Role, db  # noqa: E402
+
+GENDERS = ['male', 'female', 'non']
+BATCH = 50000
+ROLES = 30
+
+
+def populate(nactors):
+    for start in range(0, nactors, BATCH):
+        db.session.execute(Actor.__table__.insert(), [
+            {'name': f'actor{i}', 'age': 18 + i * 7919 % 60,
+             'gender': GENDERS[i % 3]}
+            for i in range(start, min(start + BATCH, nactors))
+        ])
+    movie = Movie(title='Benchmark', release_date=date(2030, 1, 1))
+    db.session.add(movie)
+    db.session.flush()
+    db.session.execute(Role.__table__.insert(), [
+        {'name': f'role{i}', 'age': 18 + i * 13 % 60,
+         'gender': GENDERS[i % 3], 'movie_id': movie.id, 'filled': False}
+        for i in range(ROLES)
+    ])
+    db.session.commit()
+    return movie.id
+
+
+def bench(client, urls, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for url in urls:
+            response = client.get(url)
+            assert response.status_code == 200, response.get_json()
+        best = min(best, time.perf_counter() - start)
+    return best / len(urls)
+
+
+def main():
+    nactors = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    app = create_app({'DATABASE_URL': 'sqlite:///:memory:',
+                      'DB_CREATE_ALL': True, 'TESTING_WITHOUT_AUTH': True})
+    with app.app_context():
+        start = time.perf_counter()
+        movie_id = populate(nactors)
+        print(f'populated {nactors:,} actors in '
+              f'{time.perf_counter() - start:.1f}s')
+        db.engine.execute('ANALYZE')
+        index = ActorIndex()
+        start = time.perf_counter()
+        index.load()
+        print(f'built the index in {time.perf_counter() - start:.1f}s')
+
+        client = app.test_client()
+        role_ids = [r.id for r in Role.query.filter_by(movie_id=movie_id)]
+        endpoints = [
+            ('movie', [f'/movie/{movie_id}/candidates']),
+            ('role', [f'/role/{id_}/candidates' for id_ in role_ids[:3]]),
+        ]
+        answers = {}
+        for name, extension in [('sql', None), ('index', index)]:
+            app.extensions['actor_index'] = extension
+            for endpoint, urls in endpoints:
+                answers.setdefault(endpoint, []).append(
+                    [client.get(url).get_json() for url in urls])
+                print(f'{endpoint:>6} candidates, {name:>5}: '
+                      f'{bench(client, urls) * 1000:9.3f} ms')
+        for endpoint, (sql, indexed) in answers.items():
+            assert sql == indexed, endpoint
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Load test requires_auth with locally signed tokens, no Auth0 involved:
+a pool of users' tokens with the token cache on and off.  Signing is
+slow in pure python, so the pool is minted up front and reused; with
+the cache off every request verifies the signature like a new token.
+
+python benchmarks/bench_auth.py [number of requests] [key bits]
+"""
+
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskr import create_app  # noqa: E402
+from flaskr.issuer import LocalIssuer  # noqa: E402
+from flaskr.models import Actor, db  # noqa: E402
+
+URL = '/actors?page=1'
+USERS = 50
+
+
+def run(client, tokens):
+    start = time.perf_counter()
+    for token in tokens:
+        response = client.get(
+            URL, headers={'Authorization': f'Bearer {token}'})
+        assert response.status_code == 200, response.get_json()
+    return time.perf_counter() - start
+
+
+def main():
+    nrequests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    bits = int(sys.argv[2]) if len(sys.argv) > 2 else 2048
+    start = time.perf_counter()
+    issuer = LocalIssuer(bits=bits)
+    print(f'generated a {bits} bit key in '
+          f'{time.perf_counter() - start:.1f}s')
+    app = create_app({'DATABASE_URL': 'sqlite:///:memory:',
+                      'DB_CREATE_ALL': True, 'LOCAL_ISSUER': issuer})
+    with app.app_context():
+        db.session.add(Actor(name='somebody', age=30, gender='non'))
+        db.session.commit()
+        client = app.test_client()
+        start = time.perf_counter()
+        pool = [issuer.mint('assistant', sub=f'local|user{i}')
+                for i in range(USERS)]
+        print(f'minted {USERS} tokens at '
+              f'{(time.perf_counter() - start) / USERS * 1000:.1f} ms each')
+        tokens = [pool[i % USERS] for i in range(nrequests)]
+        # the first request waits for the keys
+        run(client, pool[:1])
+
+        token_cache = app.extensions['token_cache']
+        maxsize = token_cache.maxsize
+        for name, cache_size in [('cached', maxsize), ('uncached', 0)]:
+            token_cache.maxsize = cache_size
+            token_cache.entries.clear()
+            seconds = run(client, tokens)
+            print(f'{name:>10}: {nrequests / seconds:8.0f} requests/s, '
+                  f'{seconds / nrequests * 1000:6.3f} ms each')
+
+
+if __name__ == '__main__':
+    main()
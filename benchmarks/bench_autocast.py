@@ -0,0 +1,44 @@
+"""
+Time the autocast solver for movies with thousands of roles.
+
+python benchmarks/bench_autocast.py [largest number of roles]
+"""
+
+import sys
+import os
+import random
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskr.matching import assign_by_age  # noqa: E402
+
+AGES = range(18, 90)
+ACTORS_PER_AGE = 300
+
+
+def bench(nroles, repeat=3):
+    rng = random.Random(nroles)
+    role_ages = sorted(rng.choice(AGES) for _ in range(nroles))
+    actor_ages = [(age, rng.randint(0, ACTORS_PER_AGE)) for age in AGES]
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        assigned = assign_by_age(role_ages, actor_ages)
+        best = min(best, time.perf_counter() - start)
+    filled = sum(age is not None for age in assigned)
+    return best, filled
+
+
+def main():
+    largest = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    nroles = 1000
+    while nroles <= largest:
+        seconds, filled = bench(nroles)
+        print(f'{nroles:>7,} roles: {seconds * 1000:8.1f} ms, '
+              f'{filled:,} filled')
+        nroles *= 2
+
+
+if __name__ == '__main__':
+    main()
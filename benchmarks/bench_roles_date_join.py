@@ -0,0 +1,92 @@
+"""
+Compare the old derived table join behind /roles?start_date=&end_date=
+with the direct join on role.movie_id.
+
+python benchmarks/bench_roles_date_join.py [number of roles]
+"""
+
+import sys
+import os
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskr import create_app  # noqa: E402
+from flaskr.controllers import filter_release_dates  # noqa: E402
+from flaskr.models import Movie, Role, db  # noqa: E402
+
+GENDERS = ['male', 'female', 'non']
+ROLES_PER_MOVIE = 20
+FIRST_RELEASE = date(2000, 1, 1)
+START_DATE = date(2020, 1, 1)
+END_DATE = date(2020, 3, 1)
+BATCH = 50000
+
+
+def populate(nroles):
+    nmovies = nroles // ROLES_PER_MOVIE
+    db.session.execute(Movie.__table__.insert(), [
+        {'title': f'movie{i}',
+         'release_date': FIRST_RELEASE + timedelta(days=i % 9000)}
+        for i in range(nmovies)
+    ])
+    for start in range(0, nroles, BATCH):
+        db.session.execute(Role.__table__.insert(), [
+            {'name': f'role{i}', 'age': 18 + i % 60,
+             'gender': GENDERS[i % 3], 'filled': i % 2 == 0,
+             'movie_id': i % nmovies + 1}
+            for i in range(start, min(start + BATCH, nroles))
+        ])
+    db.session.commit()
+
+
+def old_query():
+    sub = Movie.query.filter(Movie.release_date > START_DATE,
+                             Movie.release_date < END_DATE)
+    return Role.query.filter_by(gender='female').join(sub.subquery())
+
+
+def new_query():
+    return filter_release_dates(Role.query.filter_by(gender='female'),
+                                START_DATE, END_DATE)
+
+
+def plan(query):
+    compiled = query.statement.compile(db.engine)
+    params = [compiled.params[name] for name in compiled.positiontup]
+    rows = db.engine.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+    return '\n'.join('    ' + row[-1] for row in rows)
+
+
+def bench(make_query, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ids = [r.id for r in make_query().with_entities(Role.id)]
+        best = min(best, time.perf_counter() - start)
+    return best, ids
+
+
+def main():
+    nroles = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    app = create_app({'DATABASE_URL': 'sqlite:///:memory:',
+                      'DB_CREATE_ALL': True})
+    with app.app_context():
+        start = time.perf_counter()
+        populate(nroles)
+        print(f'populated {nroles:,} roles in '
+              f'{time.perf_counter() - start:.1f}s')
+        db.engine.execute('ANALYZE')
+        results = {}
+        for name, make_query in [('subquery join', old_query),
+                                 ('direct join', new_query)]:
+            seconds, ids = bench(make_query)
+            results[name] = sorted(ids)
+            print(f'{name}: {seconds * 1000:.1f} ms, {len(ids):,} roles')
+            print(plan(make_query()))
+        assert results['subquery join'] == results['direct join']
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Compare serializing actors through ORM instances with the
+column projection used by the list endpoints.
+
+python benchmarks/bench_serialize.py [number of actors]
+"""
+
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flaskr import create_app  # noqa: E402
+from flaskr.models import Actor, db  # noqa: E402
+
+GENDERS = ['male', 'female', 'non']
+
+
+def populate(nactors):
+    rows = [{'name': f'actor{i}', 'age': 18 + i % 60,
+             'gender': GENDERS[i % 3]} for i in range(nactors)]
+    db.session.execute(Actor.__table__.insert(), rows)
+    db.session.commit()
+
+
+def orm_path():
+    return [a.format() for a in Actor.query]
+
+
+def projection_path():
+    query = Actor.query.with_entities(*Actor.columns())
+    return [Actor.format_row(r) for r in query]
+
+
+def bench(func, nactors, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+        db.session.remove()
+    return nactors / best
+
+
+def main():
+    nactors = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    app = create_app({'DATABASE_URL': 'sqlite:///:memory:',
+                      'DB_CREATE_ALL': True})
+    with app.app_context():
+        populate(nactors)
+        assert orm_path() == projection_path()
+        for name, func in [('orm', orm_path),
+                           ('projection', projection_path)]:
+            print(f'{name:>12}: {bench(func, nactors):12,.0f} rows/sec')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Time create_app the way a fresh worker runs it, with and without
+creating the tables at startup.
+
+python benchmarks/bench_startup.py [database url] [runs]
+
+The database defaults to a throw away sqlite file.  Point it at a
+copy of the production postgres to see the reflection round trips.
+"""
+
+import sys
+import os
+import statistics
+import subprocess
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# run in a new interpreter so every boot is cold
+BOOT = '''
+import sys, time
+sys.path.insert(0, {root!r})
+from flaskr import create_app
+start = time.perf_counter()
+app = create_app({{'DATABASE_URL': {url!r}, 'DB_CREATE_ALL': {create}}})
+with app.app_context():
+    # the first request opens a connection either way
+    from flaskr.models import db
+    db.engine.connect().close()
+print(time.perf_counter() - start)
+'''
+
+
+def boot(url, create):
+    code = BOOT.format(root=ROOT, url=url, create=create)
+    out = subprocess.run([sys.executable, '-c', code], check=True,
+                         capture_output=True, text=True).stdout
+    return float(out)
+
+
+def main():
+    tmp = tempfile.TemporaryDirectory()
+    url = sys.argv[1] if len(sys.argv) > 1 else \
+        f'sqlite:///{tmp.name}/startup.db'
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    # make sure the schema is there before timing
+    boot(url, True)
+    for name, create in [('create_all at startup', True),
+                         ('no create_all', False)]:
+        times = [boot(url, create) for _ in range(runs)]
+        print(f'{name:>22}: median {statistics.median(times) * 1000:.1f} ms'
+              f' over {runs} boots')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,15 @@
 import os
 from flask import Flask
 from flask_cors import CORS
-from .models import setup_db
+from .models import setup_db, db
+from . import pool
+from .config import to_bool
 from .controllers import register_views
+from .auth import setup_auth, register_stats_views
+from .issuer import setup_issuer
+from .encoders import setup_encoder
+from .cache import setup_cache
+from .matching import setup_index
 
 
 def create_app(test_config=None):
@@ -13,7 +20,17 @@ def create_app(test_config=None):
         dbpath = app.config.pop('DATABASE_URL')
     else:
         dbpath = os.environ['DATABASE_URL']
+        for key in [*pool.POOL_CONFIG, 'POOL_STATS', 'ACTOR_INDEX',
+                    'JWKS_BACKGROUND_REFRESH', 'LOCAL_ISSUER',
+                    'LOCAL_ISSUER_KEY']:
+            if key in os.environ:
+                app.config[key] = os.environ[key]
     setup_db(app, dbpath)
+    setup_issuer(app)
+    setup_auth(app)
+    setup_encoder(app)
+    setup_cache(app)
+    setup_index(app)
 
     CORS(app)
 
@@ -30,5 +47,8 @@ def create_app(test_config=None):
         return response
 
     register_views(app)
+    register_stats_views(app)
+    if to_bool(app.config.get('POOL_STATS', False)):
+        pool.register_views(app, db)
 
     return app
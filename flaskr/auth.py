@@ -1,25 +1,43 @@
+import os
 from os import environ
 from functools import wraps
+from collections import OrderedDict
+import hashlib
 import json
-from flask import redirect, url_for, jsonify, request
-from dotenv import load_dotenv, find_dotenv
+import threading
+import time
+from flask import redirect, url_for, request, current_app
 
 from urllib.request import urlopen
 from urllib.parse import urlencode
-from jose import jwt
+from .encoders import jsonify
+from .config import to_bool
 
-ENV_FILE = find_dotenv()
-if ENV_FILE:
-    load_dotenv(ENV_FILE)
+# jose is imported where tokens are decoded.  It pulls in ecdsa, which
+# takes longer to import than the rest of the app put together.
 
-AUTH0_CALLBACK_URL = environ.get('AUTH0_CALLBACK_URL')
-AUTH0_CLIENT_ID = environ.get('AUTH0_CLIENT_ID')
-AUTH0_DOMAIN = environ.get('AUTH0_DOMAIN')
-AUTH0_BASE_URL = 'https://' + AUTH0_DOMAIN
-AUTH0_AUDIENCE = environ.get('AUTH0_AUDIENCE')
+# read from the app config, falling back on the environment and .env
+AUTH0_SETTINGS = ['AUTH0_CALLBACK_URL', 'AUTH0_CLIENT_ID',
+                  'AUTH0_DOMAIN', 'AUTH0_AUDIENCE']
 
 ALGORITHMS = ["RS256"]
 
+# seconds a fetched key set is trusted before it is refetched
+JWKS_TTL = 600
+# minimum seconds between fetches triggered by an unknown kid or by
+# a failed refresh, so garbage tokens can't hammer Auth0
+JWKS_MIN_REFETCH_INTERVAL = 30
+# seconds before the keys go stale that the background refresher
+# fetches them
+JWKS_REFRESH_MARGIN = 60
+# seconds a request waits for the background refresher's first fetch
+JWKS_FIRST_FETCH_TIMEOUT = 10
+# number of verified tokens remembered, 0 turns the cache off
+TOKEN_CACHE_SIZE = 1024
+# permission needed for the /_internal stats, grant it in Auth0 to
+# whoever runs the servers
+STATS_PERMISSION = 'view:stats'
+
 
 class AuthError(Exception):
     def __init__(self, name, description, code=401):
@@ -28,6 +46,294 @@ class AuthError(Exception):
         self.code = code
 
 
+def url_fetcher(url, timeout=5):
+    """Return a fetcher that downloads the jwks document at url."""
+    def fetch():
+        with urlopen(url, timeout=timeout) as f:
+            return json.loads(f.read())
+    return fetch
+
+
+def file_fetcher(path):
+    """Return a fetcher that reads the jwks document from a local file."""
+    def fetch():
+        with open(path) as f:
+            return json.load(f)
+    return fetch
+
+
+def construct_key(jwk):
+    """Return jwk as a jose key object ready to verify RS256 signatures,
+    or None if it isn't such a key.
+    """
+    from jose import jwk as jose_jwk
+    try:
+        return jose_jwk.construct(jwk, ALGORITHMS[0])
+    except Exception:
+        return None
+
+
+def jwks_unavailable():
+    return AuthError(
+        name='jwks_unavailable',
+        description='Unable to fetch signing keys',
+        code=503
+    )
+
+
+class JWKSCache:
+    """Keep the JSON Web Key Set in process.
+
+    fetcher -> callable returning the parsed jwks document
+    ttl -> seconds before the keys are considered stale
+    min_refetch_interval -> seconds to wait before fetching again after
+        an unknown kid or a failed fetch
+    parse -> applied to each jwk when the set is fetched, keys it
+        returns None for are dropped.  get_key returns its result.
+
+    When a refresh fails the stale keys keep being served.  After
+    start() a background thread does all the fetching.
+    """
+
+    def __init__(self, fetcher, ttl=JWKS_TTL,
+                 min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL,
+                 clock=time.monotonic, parse=None):
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.clock = clock
+        self.parse = parse
+        self.keys = {}
+        self.fetched_at = None
+        self.attempted_at = None
+        self.lock = threading.Lock()
+        # background refresher state, see start
+        self.background = False
+        self.thread = None
+        self.pid = None
+        self.margin = JWKS_REFRESH_MARGIN
+        self.first_fetch_timeout = JWKS_FIRST_FETCH_TIMEOUT
+        self.kid_missed = False
+        self.wakeup = threading.Event()
+        self.attempted = threading.Event()
+
+    def refresh(self):
+        """Fetch the key set.  Return True on success."""
+        self.attempted_at = self.clock()
+        try:
+            jwks = self.fetcher()
+            keys = {key['kid']: key for key in jwks['keys']}
+            if self.parse is not None:
+                keys = {kid: self.parse(key) for kid, key in keys.items()}
+                keys = {kid: key for kid, key in keys.items()
+                        if key is not None}
+        except Exception:
+            if not self.keys:
+                raise jwks_unavailable()
+            return False
+        self.keys = keys
+        self.fetched_at = self.attempted_at
+        return True
+
+    def can_refetch(self, now):
+        return (self.attempted_at is None or
+                now - self.attempted_at >= self.min_refetch_interval)
+
+    def get_key(self, kid):
+        """Return the jwk for kid or None if the issuer doesn't have it."""
+        if self.background:
+            return self.get_prefetched_key(kid)
+        with self.lock:
+            now = self.clock()
+            stale = (self.fetched_at is None or
+                     now - self.fetched_at >= self.ttl)
+            # a kid it doesn't know may mean the issuer rotated its keys
+            if (stale or kid not in self.keys) and self.can_refetch(now):
+                self.refresh()
+            elif not self.keys:
+                # no keys ever fetched and too soon to try again, so an
+                # issuer that is down isn't called on every request
+                raise jwks_unavailable()
+            return self.keys.get(kid)
+
+    def start(self, margin=JWKS_REFRESH_MARGIN,
+              first_fetch_timeout=JWKS_FIRST_FETCH_TIMEOUT, lazy=False):
+        """Fetch the keys from a background thread from now on.
+
+        It fetches margin seconds before the keys go stale and soon
+        after a request asks for an unknown kid, so requests never wait
+        on the issuer, except for the first fetch up to
+        first_fetch_timeout seconds.  A forked process starts its own
+        thread on its first get_key.  With lazy, so does this one, and
+        processes that never check a token never fetch.
+        """
+        with self.lock:
+            self.margin = margin
+            self.first_fetch_timeout = first_fetch_timeout
+            self.background = True
+            if lazy:
+                return
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(
+                target=self.run, name='jwks-refresher', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            if self.can_refetch(self.clock()):
+                self.kid_missed = False
+                try:
+                    self.refresh()
+                except AuthError:
+                    # nothing fetched yet, retried like a failed refresh
+                    pass
+                self.attempted.set()
+            self.wakeup.wait(self.seconds_to_refresh())
+            self.wakeup.clear()
+
+    def seconds_to_refresh(self):
+        """Return how long the refresher sleeps before its next fetch."""
+        failed = (self.fetched_at is None or
+                  self.fetched_at < self.attempted_at)
+        due = self.attempted_at + self.min_refetch_interval
+        if not (failed or self.kid_missed):
+            due = max(due, self.fetched_at + self.ttl - self.margin)
+        return max(due - self.clock(), 0)
+
+    def get_prefetched_key(self, kid):
+        if self.pid != os.getpid():
+            self.start(self.margin, self.first_fetch_timeout)
+        if not self.keys:
+            self.attempted.wait(self.first_fetch_timeout)
+        key = self.keys.get(kid)
+        if key is None:
+            self.kid_missed = True
+            self.wakeup.set()
+            if not self.keys:
+                raise jwks_unavailable()
+        return key
+
+
+def permission_set(payload):
+    """Return the token's permissions as a frozenset, None if absent."""
+    permissions = payload.get('permissions')
+    return None if permissions is None else frozenset(permissions)
+
+
+class TokenCache:
+    """LRU cache of verified jwt payloads keyed by a hash of the token.
+
+    Each entry is a (payload, permission set) pair so the permission
+    checks don't rebuild the set per request.
+    An entry is dropped when the cache is full or once the token's
+    exp claim has passed.  Tokens without exp are never cached.
+    """
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        """Return the cached (payload, permissions) for token or None."""
+        key = self.key(token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0]['exp'] <= self.clock():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, token, payload, permissions):
+        exp = payload.get('exp')
+        if self.maxsize <= 0 or not isinstance(exp, (int, float)):
+            return
+        with self.lock:
+            self.entries[self.key(token)] = (payload, permissions)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries)
+        }
+
+
+def missing_domain():
+    raise RuntimeError('AUTH0_DOMAIN is not configured')
+
+
+def load_settings(app):
+    """Fill in the AUTH0_* config keys the app wasn't given.
+
+    The .env file is only read when the environment lacks some of
+    them, and never for apps testing without auth.
+    """
+    missing = any(app.config.get(k) is None and k not in environ
+                  for k in AUTH0_SETTINGS)
+    if missing and not app.config.get('TESTING_WITHOUT_AUTH'):
+        from dotenv import load_dotenv, find_dotenv
+        env_file = find_dotenv()
+        if env_file:
+            load_dotenv(env_file)
+    for key in AUTH0_SETTINGS:
+        if app.config.get(key) is None:
+            app.config[key] = environ.get(key)
+
+
+def setup_auth(app):
+    """Resolve the Auth0 settings and attach the jwks cache and the
+    verified token cache to app.
+
+    JWKS_FETCHER (a callable) or JWKS_FILE replace the download from
+    Auth0, which is what the tests use.  Unless JWKS_BACKGROUND_REFRESH
+    is off, a background thread keeps the keys fetched and parsed.
+    """
+    load_settings(app)
+    fetcher = app.config.get('JWKS_FETCHER')
+    if fetcher is None:
+        domain = app.config.get('AUTH0_DOMAIN')
+        if app.config.get('JWKS_FILE'):
+            fetcher = file_fetcher(app.config['JWKS_FILE'])
+        elif domain:
+            fetcher = url_fetcher(f'https://{domain}/.well-known/jwks.json')
+        else:
+            fetcher = missing_domain
+    jwks_cache = app.extensions['jwks_cache'] = JWKSCache(
+        fetcher,
+        ttl=app.config.get('JWKS_TTL', JWKS_TTL),
+        min_refetch_interval=app.config.get(
+            'JWKS_MIN_REFETCH_INTERVAL', JWKS_MIN_REFETCH_INTERVAL),
+        parse=construct_key
+    )
+    background = to_bool(app.config.get('JWKS_BACKGROUND_REFRESH', True))
+    if (background and fetcher is not missing_domain and
+            not app.config.get('TESTING_WITHOUT_AUTH')):
+        # started by the first token checked, not by manage.py commands
+        # and scripts that only need the app
+        jwks_cache.start(
+            app.config.get('JWKS_REFRESH_MARGIN', JWKS_REFRESH_MARGIN),
+            lazy=True)
+    app.extensions['token_cache'] = TokenCache(
+        app.config.get('TOKEN_CACHE_SIZE', TOKEN_CACHE_SIZE))
+
+
 # Format error response and append status code
 def get_token_auth_header():
     """Obtains the Access Token from the Authorization Header
@@ -68,8 +374,20 @@ def verify_decode_jwt(token):
 
     Raise an error if the token is invalid in any way.
     """
-    jsonurl = urlopen("https://" + AUTH0_DOMAIN + "/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
+    return verify_token(token)[0]
+
+
+def verify_token(token):
+    """
+    Return (payload, permission set) for the token.
+
+    Tokens that were already verified come from the token cache.
+    """
+    token_cache = current_app.extensions['token_cache']
+    entry = token_cache.get(token)
+    if entry is not None:
+        return entry
+    from jose import jwt
     try:
         unverified_header = jwt.get_unverified_header(token)
     except Exception:
@@ -77,33 +395,34 @@ def verify_decode_jwt(token):
             name="invalid_header",
             description="Authorization malformed."
         )
-    rsa_key = {}
-    if 'kid' not in unverified_header:
+    if ('kid' not in unverified_header or
+            unverified_header.get('alg') not in ALGORITHMS):
         raise AuthError(
             name='invalid_header',
             description='Authorization malformed.'
         )
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"]
-            }
-    if not rsa_key:
+    jwks_cache = current_app.extensions['jwks_cache']
+    key = jwks_cache.get_key(unverified_header['kid'])
+    if key is None:
         raise AuthError(
             name="invalid_header",
             description="Unable to find appropriate key"
         )
+    # the key was parsed when it was fetched, so check the signature
+    # with it directly and leave only the claims to jwt.decode
+    if not verify_signature(token, key):
+        raise AuthError(
+            name="invalid_header",
+            description="Unable to parse authentication token."
+        )
     try:
         payload = jwt.decode(
             token,
-            rsa_key,
+            None,
             algorithms=ALGORITHMS,
-            audience=AUTH0_AUDIENCE,
-            issuer="https://" + AUTH0_DOMAIN + "/"
+            audience=current_app.config['AUTH0_AUDIENCE'],
+            issuer=f"https://{current_app.config['AUTH0_DOMAIN']}/",
+            options={'verify_signature': False}
         )
     except jwt.ExpiredSignatureError:
         raise AuthError(
@@ -121,19 +440,40 @@ def verify_decode_jwt(token):
             name="invalid_header",
             description="Unable to parse authentication token."
         )
-    return payload
+    permissions = permission_set(payload)
+    token_cache.set(token, payload, permissions)
+    return payload, permissions
+
+
+def verify_signature(token, key):
+    """Return whether key, a jose key object, signed token."""
+    from jose.utils import base64url_decode
+    signing_input, _, signature = token.rpartition('.')
+    try:
+        return key.verify(signing_input.encode(),
+                          base64url_decode(signature.encode()))
+    except Exception:
+        return False
 
 
-def check_permissions(permission, payload):
-    if not permission:
+def check_permissions(required, permissions, any_of=False):
+    """
+    required -> frozenset of permission names, empty means no check
+    permissions -> the token's permission set, None if it had none
+    any_of -> one of the required permissions is enough
+    """
+    if not required:
         return True
-    permissions = payload.get('permissions')
     if permissions is None:
         raise AuthError(
             name='invalid_claims',
             description='Permissions not included in JWT.'
         )
-    if permission not in permissions:
+    if any_of:
+        allowed = not permissions.isdisjoint(required)
+    else:
+        allowed = required <= permissions
+    if not allowed:
         raise AuthError(
             name='invalid_claims',
             description='Permission not found.'
@@ -141,13 +481,16 @@ def check_permissions(permission, payload):
     return True
 
 
-def requires_auth(permission=''):
+def requires_auth(*permissions, any_of=False):
+    """Require all of permissions, or just one of them with any_of."""
+    required = frozenset(p for p in permissions if p)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            payload, granted = verify_token(token)
+            check_permissions(required, granted, any_of)
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -155,7 +498,7 @@ def requires_auth(permission=''):
 
 
 # used for testing functionality ignoring authorization
-def requires_auth_dummy(permission=''):
+def requires_auth_dummy(*permissions, any_of=False):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
@@ -166,15 +509,31 @@ def requires_auth_dummy(permission=''):
 
 def register_views(app):
 
+    @app.route('/verify<token>', methods=['GET'])
+    def verify_decode_route(token):
+        payload = verify_decode_jwt(token)
+        return jsonify({
+            'permissions': payload['permissions'],
+            'success': True
+        })
+
+    # The login redirects need every AUTH0_* setting.  Without them, or
+    # with a local issuer, they would send browsers to a bogus host.
+    config = app.config
+    if (app.extensions.get('local_issuer') or
+            not all(config.get(k) for k in AUTH0_SETTINGS)):
+        return
+
     # @TODO State is about mitigating a CSRF attack by attaching some
     # random info, store it on the client side (sessions), and AUTH0
     # will return the same string to check against.
     # https://en.wikipedia.org/wiki/Cross-site_request_forgery
-    authorize_url = (f"https://{AUTH0_DOMAIN}/authorize?"
-                     "audience={AUTH0_AUDIENCE}&"
+    base_url = f"https://{config['AUTH0_DOMAIN']}"
+    authorize_url = (f"{base_url}/authorize?"
+                     f"audience={config['AUTH0_AUDIENCE']}&"
                      "response_type=token&"
-                     "client_id={AUTH0_CLIENT_ID}&"
-                     "redirect_uri={AUTH0_CALLBACK_URL}")
+                     f"client_id={config['AUTH0_CLIENT_ID']}&"
+                     f"redirect_uri={config['AUTH0_CALLBACK_URL']}")
 
     @app.route('/callback')
     def callback():
@@ -191,21 +550,31 @@ def register_views(app):
         # Note that it requires https and it cannot point to localhost.
         return redirect(authorize_url)
 
-    @app.route('/verify<token>', methods=['GET'])
-    def verify_decode_route(token):
-        payload = verify_decode_jwt(token)
-        return jsonify({
-            'permissions': payload['permissions'],
-            'success': True
-        })
-
     @app.route('/logout')
     def logout():
         # Redirect user to logout endpoint
         params = {'returnTo': url_for('index', _external=True),
-                  'client_id': AUTH0_CLIENT_ID}
-        return redirect(AUTH0_BASE_URL + '/v2/logout?' + urlencode(params))
+                  'client_id': config['AUTH0_CLIENT_ID']}
+        return redirect(base_url + '/v2/logout?' + urlencode(params))
 
     #     # 1. clear the session cookies (N/A)
     #     # 2. log out with auth0 api
     #     # https://YOUR_DOMAIN/v2/logout
+
+
+def register_stats_views(app):
+    """Serve the token cache's hits, misses and size at
+    /_internal/token_cache to tokens with the view:stats permission.
+    """
+    if app.config.get('TESTING_WITHOUT_AUTH'):
+        auth = requires_auth_dummy
+    else:
+        auth = requires_auth
+
+    @app.route('/_internal/token_cache', methods=['GET'])
+    @auth(STATS_PERMISSION)
+    def get_token_cache_stats(jwt_payload):
+        return jsonify({
+            'success': True,
+            **app.extensions['token_cache'].stats()
+        })
@@ -0,0 +1,106 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+from flask import Response, current_app, request, make_response
+from .models import versions
+
+# number of responses kept by the default backend, 0 turns caching off
+RESPONSE_CACHE_SIZE = 512
+
+
+class LRUBackend:
+    """Process local least recently used store for cached responses.
+
+    A shared backend (memcached, redis...) replacing it only needs
+    get(key) returning the stored bytes or None and set(key, value).
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+def setup_cache(app):
+    """Attach the response cache backend to app.
+
+    Caching and ETags are only on with a VERSION_STORE (see
+    models.LocalCounters) shared by every process serving the
+    database.  With process local versions one worker can't tell
+    another has written, and would serve its stale copy for good.
+    A single process server can pass a LocalCounters.
+
+    RESPONSE_CACHE_BACKEND replaces the in-process LRU.
+    """
+    shared = app.config.get('VERSION_STORE') is not None
+    app.extensions['shared_versions'] = shared
+    if not shared:
+        app.extensions['response_cache'] = None
+        return
+    backend = app.config.get('RESPONSE_CACHE_BACKEND')
+    if backend is None:
+        size = app.config.get('RESPONSE_CACHE_SIZE', RESPONSE_CACHE_SIZE)
+        backend = LRUBackend(size) if size > 0 else None
+    app.extensions['response_cache'] = backend
+
+
+def cache_key(models):
+    """Return the key for the current request's response.
+
+    The endpoint, the query args in a normal order and the versions of
+    the tables the response is built from.
+    """
+    args = urlencode(sorted(request.args.items(multi=True)))
+    version = ':'.join(map(str, versions.current(*models)))
+    return f'{request.path}?{args}#{version}'
+
+
+def cached(*models):
+    """Cache a GET view's response until one of models' tables changes.
+
+    The response gets a strong ETag derived from the same key, so an
+    If-None-Match still current is answered with 304 before the view
+    runs.  Only complete 200 responses are stored; streamed pages are
+    not.  Without shared versions the view just runs.
+    """
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not current_app.extensions.get('shared_versions'):
+                return f(*args, **kwargs)
+            key = cache_key(models)
+            etag = hashlib.sha1(key.encode()).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            backend = current_app.extensions.get('response_cache')
+            body = backend.get(key) if backend is not None else None
+            if body is not None:
+                response = Response(body, mimetype='application/json')
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                if backend is not None and not response.is_streamed:
+                    backend.set(key, response.get_data())
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return cached_decorator
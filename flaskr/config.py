@@ -0,0 +1,5 @@
+def to_bool(value):
+    """Read a config flag that may come from the environment as text."""
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
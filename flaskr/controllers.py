@@ -1,9 +1,20 @@
 import sys
+import json
+from itertools import chain
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import date
 from dateutil.parser import parse
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload, selectinload
 from werkzeug.exceptions import HTTPException
-from flask import request, jsonify, abort, render_template
-from .models import (Actor, Movie, Role, Booking,
-                     rollback, close_session, add_all)
+from flask import request, abort, render_template, current_app
+from .models import (Actor, Movie, Role, Booking, DbTypeError,
+                     rollback, close_session, add_all, bulk_insert)
+from .encoders import jsonify, stream_json, STREAM_THRESHOLD
+from .cache import cached
+from .matching import (candidate_query, group_candidates, index_candidates,
+                       autocast, CANDIDATE_LIMIT, MAX_CANDIDATE_LIMIT,
+                       MAX_AGE_GAP)
 from .auth import AuthError, requires_auth_dummy
 from .auth import requires_auth as requires_auth_
 from .auth import register_views as reg_auth_views
@@ -13,18 +24,30 @@ from .auth import register_views as reg_auth_views
 # GET /movies
 # GET /roles
 # GET /movie/<id>
+# GET /movie/<id>/candidates
+# GET /role/<id>/candidates
 # POST /roles/<id>
 # POST /actor
 # POST /movie
+# POST /actors/bulk
+# POST /movies/bulk
 # POST /actor/<id>/role/<id>
+# POST /bookings
+# POST /movie/<id>/autocast
 # DELETE /actor/<id>
 # DELETE /movie/<id>
 # DELETE /role/<id>
+# DELETE /movie/<id>/roles
 # PATCH /actor/<id>
 # PATCH /movie/<id>
 # PATCH /role/<id>
+# PATCH /movie/<id>/roles
 
 PAGE_LENGTH = 10
+# rows fetched per round trip while streaming a page
+STREAM_BATCH = 500
+# rows per insert transaction in the bulk endpoints
+BULK_BATCH = 1000
 
 
 def get_json():
@@ -58,20 +81,157 @@ def commit_data(func):
     return out
 
 
+def encode_cursor(model, entry):
+    """Return an opaque cursor pointing just past entry."""
+    value = getattr(entry, model.sort_key)
+    if isinstance(value, date):
+        value = value.isoformat()
+    raw = json.dumps([value, entry.id]).encode()
+    return urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(model, cursor):
+    """Return the (sort value, id) pair encoded in cursor.
+
+    The value has to be of the sort column's type, so a tampered
+    cursor is a 422 rather than a database error.
+    """
+    try:
+        raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, id_ = json.loads(raw)
+        python_type = getattr(model, model.sort_key).type.python_type
+        if python_type is date:
+            value = date.fromisoformat(value)
+        if not isinstance(value, python_type) or isinstance(value, bool):
+            raise TypeError(value)
+        return value, int(id_)
+    except Exception:
+        abort(422, description='Malformed cursor')
+
+
+def get_includes(model):
+    """Return the relationships named in the 'include' arg."""
+    include = request.args.get('include')
+    if not include:
+        return []
+    names = include.split(',')
+    unknown = [n for n in names if n not in model.expandable]
+    if unknown:
+        abort(422, description=f'Cannot include {", ".join(unknown)}')
+    return names
+
+
+def page_response(model, results, page_length, format_,
+                  next_name, next_value):
+    """Return the response for a page of results.
+
+    results -> iterable of up to page_length + 1 rows, the extra row
+        only tells us that there is a next page
+    next_name -> response member pointing to the next page
+    next_value -> function of the page's last row giving that pointer
+
+    Pages longer than STREAM_THRESHOLD are streamed.
+    """
+    plural = model.plural()
+    if not is_streamed(page_length):
+        results = list(results)
+        next_ = None
+        if len(results) > page_length:
+            results = results[:page_length]
+            next_ = next_value(results[-1])
+        return jsonify({
+            'success': True,
+            plural: [format_(r) for r in results],
+            next_name: next_
+        })
+
+    pointer = {next_name: None}
+
+    def entries():
+        last = None
+        for i, row in enumerate(results):
+            if i == page_length:
+                pointer[next_name] = next_value(last)
+                break
+            last = row
+            yield format_(row)
+    return stream_json({'success': True}, plural, entries(), lambda: pointer)
+
+
+def is_streamed(page_length):
+    threshold = current_app.config.get('STREAM_THRESHOLD', STREAM_THRESHOLD)
+    return page_length > threshold
+
+
+def get_keyset_page(model, query, page_length, format_):
+    """Return the page of results following the 'after' cursor.
+
+    Seeks on (sort_key, id) instead of counting and offsetting, so
+    deep pages cost the same as the first one.  An empty cursor
+    starts from the beginning.
+    """
+    sort_column = getattr(model, model.sort_key)
+    query = query.order_by(sort_column, model.id)
+    after = request.args.get('after')
+    if after:
+        value, id_ = decode_cursor(model, after)
+        query = query.filter(
+            sort_column >= value,
+            or_(sort_column > value, and_(sort_column == value,
+                                          model.id > id_)))
+    return page_response(
+        model, query.limit(page_length + 1), page_length, format_,
+        'next_cursor', lambda last: encode_cursor(model, last))
+
+
+def get_page_length(model):
+    """Return the requested page length capped at the model's maximum."""
+    page_length = request.args.get("page_length", PAGE_LENGTH, type=int)
+    if page_length < 1:
+        abort(422, description='page_length must be positive')
+    return min(page_length, model.max_page_length)
+
+
+def get_page_number():
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(422, description='page must be positive')
+    return page
+
+
 def get_paginate(model, query):
     # @TODO check out Model.paginate
-    page = request.args.get('page', 1, type=int)
-    page_length = request.args.get("page_length", PAGE_LENGTH, type=int)
+    page_length = get_page_length(model)
+    includes = get_includes(model)
+    if includes:
+        # included relationships are loaded with one extra query per page
+        query = query.options(*[selectinload(getattr(model, name))
+                                for name in includes])
+
+        def format_(entry):
+            return entry.format(includes)
+    else:
+        # plain column tuples skip building ORM instances
+        query = query.with_entities(*model.columns())
+        format_ = model.format_row
+        if is_streamed(page_length):
+            query = query.yield_per(STREAM_BATCH)
+    if 'after' in request.args:
+        return get_keyset_page(model, query, page_length, format_)
+    page = get_page_number()
     offset = (page - 1) * page_length
 
-    if offset > query.count():
-        abort(404, description=f'Page number {page} is out of bounds')
-    results = query.limit(page_length).offset(offset)
-    formatted_results = [r.format() for r in results]
-    return jsonify({
-        'success': True,
-        model.plural(): formatted_results
-    })
+    # One query: the extra row tells us whether there is a next page
+    # and an empty result past the first page is out of bounds.
+    results = iter(query.limit(page_length + 1).offset(offset))
+    first = next(results, None)
+    if first is None:
+        if page > 1:
+            abort(404, description=f'Page number {page} is out of bounds')
+    else:
+        results = chain([first], results)
+    return page_response(model, results, page_length, format_,
+                         'next_page', lambda last: page + 1)
 
 
 def post(model, column_names):
@@ -94,18 +254,107 @@ def post(model, column_names):
         })
 
 
-def patch(model, id_, column_names):
-    entry = model.query.get(id_)
-    if entry is None:
-        abort(404, description=f'{model.singular()} {id_} not found.')
+def read_entries():
+    """Yield (index, entry) for each entry of a bulk request.
 
-    # The decision here is to ignore any superflous info the client provided
-    updates = {k: get_json()[k] for k in column_names if k in get_json()}
+    The body is either a json array or, with the application/x-ndjson
+    content type, one json object per line read as it streams in.
+    An entry that can't be parsed is yielded as None.
+    """
+    if request.mimetype == 'application/x-ndjson':
+        lines = (line for line in request.stream if line.strip())
+        for index, line in enumerate(lines):
+            try:
+                yield index, json.loads(line)
+            except ValueError:
+                yield index, None
+        return
+    entries = get_json()
+    if not isinstance(entries, list):
+        abort(422, description='json array required')
+    yield from enumerate(entries)
+
+
+def validate_entry(model, column_names, entry):
+    """Return the column values for entry as the model's validators
+    leave them.  Raise DbTypeError with a description if entry is bad.
+    """
+    if not isinstance(entry, dict):
+        raise DbTypeError('json object required')
+    for kword in column_names:
+        if entry.get(kword) is None:
+            raise DbTypeError(f'{kword} required')
+    try:
+        validated = model(**{k: entry[k] for k in column_names})
+    except (DbTypeError, TypeError, ValueError):
+        raise DbTypeError('Invalid data')
+    return {k: getattr(validated, k) for k in column_names}
 
-    def f():
-        entry.update(updates)
-        return entry.format()
-    formatted_entry = commit_data(f)
+
+def insert_batch(model, batch, errors):
+    """Insert batch, a list of (index, values), in one transaction.
+
+    If the database rejects the batch, the rows are retried one by one
+    so only the bad ones end up in errors.  Return the number inserted.
+    """
+    try:
+        bulk_insert(model, [values for _, values in batch])
+        return len(batch)
+    except Exception:
+        rollback()
+    inserted = 0
+    for index, values in batch:
+        try:
+            bulk_insert(model, [values])
+            inserted += 1
+        except Exception:
+            rollback()
+            errors.append({'index': index, 'description': 'Invalid data'})
+    return inserted
+
+
+def post_bulk(model, column_names):
+    errors = []
+    inserted = 0
+    batch = []
+    for index, entry in read_entries():
+        try:
+            batch.append((index, validate_entry(model, column_names, entry)))
+        except DbTypeError as e:
+            errors.append({'index': index, 'description': str(e)})
+        if len(batch) == BULK_BATCH:
+            inserted += insert_batch(model, batch, errors)
+            batch = []
+    if batch:
+        inserted += insert_batch(model, batch, errors)
+    close_session()
+
+    return jsonify({
+        'success': True,
+        'inserted': inserted,
+        'errors': sorted(errors, key=lambda e: e['index'])
+        })
+
+
+def patch(model, id_, column_names):
+    # The decision here is to ignore any superflous info the client provided
+    data = request.get_json(silent=True)
+    updates = {}
+    if isinstance(data, dict):
+        updates = {k: data[k] for k in column_names if k in data}
+
+    if not updates:
+        # nothing to write, answer the way a full edit would
+        entry = model.query.get(id_)
+        if entry is None:
+            abort(404, description=f'{model.singular()} {id_} not found.')
+        get_json()
+        formatted_entry = entry.format()
+    else:
+        formatted_entry = commit_data(
+            lambda: model.update_by_id(id_, updates))
+        if formatted_entry is None:
+            abort(404, description=f'{model.singular()} {id_} not found.')
 
     return jsonify({
         'success': True,
@@ -114,11 +363,9 @@ def patch(model, id_, column_names):
 
 
 def delete(model, id_):
-    entry = model.query.get(id_)
-    if entry is None:
+    formatted_entry = commit_data(lambda: model.delete_by_id(id_))
+    if formatted_entry is None:
         abort(404, description=f'{model.singular()} {id_} not found.')
-    formatted_entry = entry.format()
-    entry.delete()
 
     return jsonify({
         'success': True,
@@ -140,6 +387,74 @@ def parse_age_range(age_range):
     return lower, upper
 
 
+def parse_ids(ids):
+    try:
+        return [int(i) for i in ids.split(',')]
+    except ValueError:
+        abort(422, description='Malformed ids')
+
+
+def movie_role_criteria(movie_id):
+    """Return the criteria selecting movie_id's roles from the url args.
+
+    ids -> comma separated role ids
+    gender, age, filled -> filter the same way as GET /roles
+    """
+    if not Movie.query.get(movie_id):
+        abort(404, description=f'Movie {movie_id} not found')
+    criteria = [Role.movie_id == movie_id]
+    ids = request.args.get('ids')
+    if ids:
+        criteria.append(Role.id.in_(parse_ids(ids)))
+    gender = request.args.get('gender')
+    if gender:
+        criteria.append(Role.gender == parse_gender(gender))
+    age = request.args.get('age')
+    if age:
+        lower, upper = parse_age_range(age)
+        criteria.extend([Role.age <= upper, Role.age >= lower])
+    filled = {'true': True, 'false': False}.get(
+        request.args.get('filled', '').lower())
+    if filled is not None:
+        criteria.append(Role.filled == filled)
+    return criteria
+
+
+def get_candidates(role_criteria):
+    """Return the ranked candidates of the roles matching role_criteria.
+
+    url args:
+    limit -> candidates per role
+    max_age_gap -> widest age difference in years
+    """
+    limit = request.args.get('limit', CANDIDATE_LIMIT, type=int)
+    if not 0 < limit <= MAX_CANDIDATE_LIMIT:
+        abort(422, description='limit must be between 1 and '
+                               f'{MAX_CANDIDATE_LIMIT}')
+    max_age_gap = request.args.get('max_age_gap', MAX_AGE_GAP, type=int)
+    if max_age_gap < 0:
+        abort(422, description='max_age_gap must not be negative')
+    index = current_app.extensions.get('actor_index')
+    if index is not None and index.current():
+        return index_candidates(index, role_criteria, max_age_gap, limit)
+    return group_candidates(
+        candidate_query(role_criteria, max_age_gap, limit))
+
+
+def filter_release_dates(query, start_date=None, end_date=None):
+    """Filter a Role query to movies released between the dates.
+
+    A plain join on the foreign key with the date predicates on movie
+    lets the planner use the release_date and movie_id indexes.
+    """
+    query = query.join(Movie, Role.movie_id == Movie.id)
+    if start_date:
+        query = query.filter(Movie.release_date > start_date)
+    if end_date:
+        query = query.filter(Movie.release_date < end_date)
+    return query
+
+
 def register_views(app):
 
     if app.config.get('TESTING_WITHOUT_AUTH'):
@@ -154,6 +469,7 @@ def register_views(app):
 
     @app.route('/actors', methods=['GET'])
     @requires_auth('view:actors')
+    @cached(Actor, Booking)
     def actors(jwt_payload):
         # possible filters as url args:
         # gender: {male, female, non}
@@ -173,6 +489,7 @@ def register_views(app):
 
     @app.route('/movies', methods=['GET'])
     @requires_auth('view:movies')
+    @cached(Movie, Role)
     def movies(jwt_payload):
         # @TODO think of something to order movies by
         # -- unfilled roles, start date is > today
@@ -188,6 +505,16 @@ def register_views(app):
     def post_movie(jwt_payload):
         return post(Movie, ['title', 'release_date'])
 
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('add:actors')
+    def post_actors_bulk(jwt_payload):
+        return post_bulk(Actor, ['name', 'age', 'gender'])
+
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('add:movies')
+    def post_movies_bulk(jwt_payload):
+        return post_bulk(Movie, ['title', 'release_date'])
+
     @app.route('/actor/<int:id_>', methods=['DELETE'])
     @requires_auth('delete:actors')
     def delete_actor(jwt_payload, id_):
@@ -215,6 +542,7 @@ def register_views(app):
 
     @app.route('/roles', methods=['GET'])
     @requires_auth('view:movies')
+    @cached(Role, Movie)
     def get_roles(jwt_payload):
         # possible filters as url args:
         # key word: domain
@@ -257,20 +585,16 @@ def register_views(app):
         query = Role.query.filter_by(**filters)
         if age:
             query = query.filter(Role.age <= upper, Role.age >= lower)
-        sub = Movie.query
-        if start_date:
-            sub = sub.filter(Movie.release_date > start_date)
-        if end_date:
-            sub = sub.filter(Movie.release_date < end_date)
         if start_date or end_date:
-            query = query.join(sub.subquery())
+            query = filter_release_dates(query, start_date, end_date)
 
         return get_paginate(Role, query)
 
     @app.route('/movie/<int:id_>', methods=['GET'])
     @requires_auth('view:movies')
+    @cached(Movie, Role)
     def get_movie(jwt_payload, id_):
-        movie = Movie.query.get(id_)
+        movie = Movie.query.options(joinedload(Movie.roles)).get(id_)
         if movie is None:
             abort(404, description=f'Movie {id_} not found.')
 
@@ -283,6 +607,34 @@ def register_views(app):
             'roles': formatted_rolls
             })
 
+    @app.route('/movie/<int:id_>/candidates', methods=['GET'])
+    @requires_auth('view:actors', 'view:movies')
+    @cached(Actor, Role, Booking)
+    def get_movie_candidates(jwt_payload, id_):
+        # ranks actors for every unfilled role of the movie in one query
+        matches = get_candidates([Role.movie_id == id_, ~Role.filled])
+        if not matches and not Movie.query.get(id_):
+            abort(404, description=f'Movie {id_} not found.')
+
+        return jsonify({
+            'success': True,
+            'movie': id_,
+            'roles': matches
+            })
+
+    @app.route('/role/<int:id_>/candidates', methods=['GET'])
+    @requires_auth('view:actors', 'view:movies')
+    @cached(Actor, Role, Booking)
+    def get_role_candidates(jwt_payload, id_):
+        matches = get_candidates([Role.id == id_])
+        if not matches:
+            abort(404, description=f'Role {id_} not found.')
+
+        return jsonify({
+            'success': True,
+            **matches[0]
+            })
+
     @app.route('/roles/<int:id_>', methods=['POST'])
     @requires_auth('add:roles')
     def post_roles(jwt_payload, id_):
@@ -316,6 +668,42 @@ def register_views(app):
     def delete_roll(jwt_payload, id_):
         return delete(Role, id_)
 
+    @app.route('/movie/<int:id_>/roles', methods=['PATCH'])
+    @requires_auth('edit:roles')
+    def patch_movie_roles(jwt_payload, id_):
+        # edits every role of the movie selected by the url args
+        # (see movie_role_criteria) with one UPDATE
+        criteria = movie_role_criteria(id_)
+        data = get_json()
+        updates = {}
+        if isinstance(data, dict):
+            updates = {k: data[k] for k in ['name', 'age', 'gender', 'filled']
+                       if k in data}
+        if not updates:
+            abort(422, description='name, age, gender or filled required')
+
+        roles = commit_data(lambda: Role.update_where(criteria, updates))
+        return jsonify({
+            'success': True,
+            'movie': id_,
+            'num_roles': len(roles),
+            'roles': roles
+            })
+
+    @app.route('/movie/<int:id_>/roles', methods=['DELETE'])
+    @requires_auth('delete:roles')
+    def delete_movie_roles(jwt_payload, id_):
+        # deletes every role of the movie selected by the url args
+        # (see movie_role_criteria) with one DELETE
+        criteria = movie_role_criteria(id_)
+        roles = commit_data(lambda: Role.delete_where(criteria))
+        return jsonify({
+            'success': True,
+            'movie': id_,
+            'num_roles': len(roles),
+            'roles': roles
+            })
+
     @app.route('/actor/<int:actor_id>/role/<int:role_id>', methods=['POST'])
     @requires_auth('book:actors')
     def book_actor(jwt_payload, actor_id, role_id):
@@ -324,8 +712,7 @@ def register_views(app):
         if not (actor and role):
             abort(404, description='Actor or role not found')
 
-        role.update(filled=True)
-        commit_data(lambda: Booking(actor_id=actor_id, role_id=role_id).add())
+        commit_data(lambda: Booking.book_all([(actor_id, role_id)]))
 
         return jsonify({
             'success': True,
@@ -333,6 +720,100 @@ def register_views(app):
             'role_id': role_id
             })
 
+    @app.route('/bookings', methods=['POST'])
+    @requires_auth('book:actors')
+    def post_bookings(jwt_payload):
+        # requires json formatted as a list of pairs, either
+        # [{'actor_id': actor_id, 'role_id': role_id}, ...]
+        # or [[actor_id, role_id], ...]
+        entries = get_json()
+        if not isinstance(entries, list):
+            abort(422, description='json array required')
+        pairs = []
+        for entry in entries:
+            if isinstance(entry, dict):
+                entry = [entry.get('actor_id'), entry.get('role_id')]
+            if (not isinstance(entry, list) or len(entry) != 2 or
+                    not all(isinstance(id_, int) and
+                            not isinstance(id_, bool) for id_ in entry)):
+                abort(422, description='Malformed booking')
+            pairs.append(tuple(entry))
+
+        # two IN queries resolve every actor and role
+        actor_ids = {a.id for a in Actor.query.with_entities(Actor.id)
+                     .filter(Actor.id.in_({a for a, _ in pairs}))}
+        filled = dict(Role.query.with_entities(Role.id, Role.filled)
+                      .filter(Role.id.in_({r for _, r in pairs}))
+                      .with_for_update())
+
+        booked = []
+        conflicts = []
+        for index, (actor_id, role_id) in enumerate(pairs):
+            if actor_id not in actor_ids:
+                description = 'Actor not found'
+            elif role_id not in filled:
+                description = 'Role not found'
+            elif filled[role_id]:
+                description = 'Role already filled'
+            else:
+                filled[role_id] = True
+                booked.append((actor_id, role_id))
+                continue
+            conflicts.append({
+                'index': index,
+                'actor_id': actor_id,
+                'role_id': role_id,
+                'description': description
+            })
+
+        commit_data(lambda: Booking.book_all(booked))
+        return jsonify({
+            'success': True,
+            'booked': [{'actor_id': a, 'role_id': r} for a, r in booked],
+            'conflicts': conflicts
+            })
+
+    @app.route('/movie/<int:id_>/autocast', methods=['POST'])
+    @requires_auth('book:actors')
+    def autocast_movie(jwt_payload, id_):
+        # optional json:
+        # {
+        #     'commit': bool (defaults false, a dry run),
+        #     'max_age_gap': int (defaults to any gap)
+        # }
+        options = request.get_json(silent=True) or {}
+        if not isinstance(options, dict):
+            abort(422, description='json object required')
+        commit = options.get('commit', False)
+        max_age_gap = options.get('max_age_gap')
+        if not isinstance(commit, bool):
+            abort(422, description='commit must be true or false')
+        if max_age_gap is not None and (
+                not isinstance(max_age_gap, int) or
+                isinstance(max_age_gap, bool) or max_age_gap < 0):
+            abort(422, description='max_age_gap must not be negative')
+        if not Movie.query.get(id_):
+            abort(404, description=f'Movie {id_} not found.')
+
+        def f():
+            planned = autocast(id_, max_age_gap, for_update=commit)
+            if commit:
+                Booking.book_all([(a, r) for a, r, _ in planned[0]])
+            return planned
+        bookings, unfilled = commit_data(f)
+
+        return jsonify({
+            'success': True,
+            'movie': id_,
+            'committed': commit,
+            'bookings': [
+                {'actor_id': a, 'role_id': r, 'age_gap': gap}
+                for a, r, gap in bookings
+            ],
+            'total_age_gap': sum(gap for _, _, gap in bookings),
+            'unfilled': unfilled
+            })
+
     def error_handler(error):
         return jsonify({
             'success': False,
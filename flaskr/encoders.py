@@ -0,0 +1,118 @@
+import json
+from datetime import date, datetime
+from flask import Response, current_app, stream_with_context
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# pages longer than this are streamed instead of built in memory
+STREAM_THRESHOLD = 100
+
+
+def default(o):
+    """Render dates the way flask's JSONEncoder does."""
+    if isinstance(o, datetime):
+        return http_date(o.utctimetuple())
+    if isinstance(o, date):
+        return http_date(o.timetuple())
+    raise TypeError(f'{type(o).__name__} is not JSON serializable')
+
+
+class StdlibEncoder:
+    name = 'json'
+
+    def __init__(self, sort_keys=True):
+        self.sort_keys = sort_keys
+
+    def dumps(self, obj):
+        """Return obj as compact json bytes."""
+        return json.dumps(obj, default=default, sort_keys=self.sort_keys,
+                          separators=(',', ':')).encode()
+
+
+class OrjsonEncoder:
+    name = 'orjson'
+
+    def __init__(self, sort_keys=True):
+        # passing dates through to default keeps them in http format
+        self.option = orjson.OPT_PASSTHROUGH_DATETIME
+        if sort_keys:
+            self.option |= orjson.OPT_SORT_KEYS
+
+    def dumps(self, obj):
+        return orjson.dumps(obj, default=default, option=self.option)
+
+
+ENCODERS = {
+    'json': StdlibEncoder,
+    'orjson': OrjsonEncoder
+}
+
+
+def setup_encoder(app):
+    """Attach the response encoder to app.
+
+    JSON_ENCODER is 'orjson', 'json' or an object with a dumps method
+    returning bytes.  It defaults to orjson when that is installed.
+    """
+    encoder = app.config.get('JSON_ENCODER')
+    if encoder is None:
+        encoder = 'orjson' if orjson else 'json'
+    if isinstance(encoder, str):
+        encoder = ENCODERS[encoder](
+            sort_keys=app.config.get('JSON_SORT_KEYS', True))
+    app.extensions['json_encoder'] = encoder
+
+
+def get_encoder():
+    return current_app.extensions['json_encoder']
+
+
+def jsonify(*args, **kwargs):
+    """Drop in for flask.jsonify using the app's encoder."""
+    if args and kwargs:
+        raise TypeError('jsonify() takes args or kwargs, not both')
+    if len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+    return Response(get_encoder().dumps(data) + b'\n',
+                    mimetype='application/json')
+
+
+def stream_json(head, key, items, tail=None):
+    """Return a streamed response for a json object holding a long list.
+
+    head -> dict of members written before the list
+    key -> name of the list member
+    items -> iterable of the list's entries, consumed while streaming
+    tail -> function returning a dict of members written after the
+            list, called once items are exhausted
+
+    Only one entry is encoded at a time, so memory doesn't grow with
+    the length of the list.
+    """
+    dumps = get_encoder().dumps
+
+    def members(d):
+        # the members of a dict's encoding without the braces
+        return dumps(d)[1:-1]
+
+    def generate():
+        yield b'{'
+        if head:
+            yield members(head) + b','
+        yield dumps(key) + b':['
+        for i, item in enumerate(items):
+            yield (b',' if i else b'') + dumps(item)
+        yield b']'
+        last = tail() if tail else None
+        if last:
+            yield b',' + members(last)
+        yield b'}\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
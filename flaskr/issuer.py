@@ -0,0 +1,149 @@
+import json
+import os
+import time
+from .auth import ALGORITHMS
+from .encoders import jsonify
+from .config import to_bool
+
+# Stands in for Auth0 so tests and load tests run offline.  Never turn
+# it on where real users log in: whoever has the key can mint a
+# producer token.
+
+# the permissions the Auth0 roles grant
+ROLE_PERMISSIONS = {
+    'assistant': ['view:actors', 'view:movies'],
+    'director': [
+        'add:actors', 'add:roles', 'book:actors', 'delete:actors',
+        'delete:roles', 'edit:actors', 'edit:movies', 'edit:roles',
+        'view:actors', 'view:movies'
+    ],
+}
+ROLE_PERMISSIONS['producer'] = sorted(
+    ROLE_PERMISSIONS['director'] + ['add:movies', 'delete:movies'])
+
+# Auth0 signs with 2048 bit keys, which sets the cost of verifying
+KEY_BITS = 2048
+LOCAL_DOMAIN = 'castingplusplus.local'
+LOCAL_AUDIENCE = 'castingplusplus'
+# seconds a minted token is valid
+TOKEN_LIFETIME = 3600
+
+
+class LocalIssuer:
+    """An RS256 key pair issuing tokens shaped like Auth0's.
+
+    private_key -> rsa.PrivateKey, a new bits long one if None
+    domain, audience -> the iss and aud claims, which the app checks
+        against AUTH0_DOMAIN and AUTH0_AUDIENCE
+    """
+
+    def __init__(self, private_key=None, kid='local', domain=LOCAL_DOMAIN,
+                 audience=LOCAL_AUDIENCE, bits=KEY_BITS):
+        import rsa
+        if private_key is None:
+            _, private_key = rsa.newkeys(bits)
+        self.private_key = private_key
+        self.pem = private_key.save_pkcs1().decode()
+        self.kid = kid
+        self.domain = domain
+        self.audience = audience
+
+    @classmethod
+    def from_file(cls, path, bits=KEY_BITS, **kwargs):
+        """Load the private key pem at path, generating and saving one
+        first if there is none.  Processes sharing path share the key.
+        """
+        import rsa
+        try:
+            with open(path, 'rb') as f:
+                return cls(rsa.PrivateKey.load_pkcs1(f.read()), **kwargs)
+        except FileNotFoundError:
+            pass
+        issuer = cls(bits=bits, **kwargs)
+        # write it whole under another name and link it into place, so
+        # when workers race the first one wins and nobody reads half
+        tmp = f'{path}.{os.getpid()}'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(issuer.pem)
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            return cls.from_file(path, bits, **kwargs)
+        finally:
+            os.unlink(tmp)
+        return issuer
+
+    def jwks(self):
+        """Return the public key as a jwks document."""
+        from jose.utils import long_to_base64
+        return {'keys': [{
+            'kid': self.kid,
+            'kty': 'RSA',
+            'use': 'sig',
+            'alg': ALGORITHMS[0],
+            'n': long_to_base64(self.private_key.n).decode(),
+            'e': long_to_base64(self.private_key.e).decode()
+        }]}
+
+    def write_jwks(self, path):
+        """Save the jwks document for JWKS_FILE."""
+        with open(path, 'w') as f:
+            json.dump(self.jwks(), f)
+
+    def mint(self, role=None, permissions=None, expires_in=TOKEN_LIFETIME,
+             **claims):
+        """Return a signed access token.
+
+        role -> assistant, director or producer, whose permissions the
+            token carries unless permissions is given
+        expires_in -> seconds until exp, negative for an expired token
+        claims -> added to or replacing the standard ones
+        """
+        from jose import jwt
+        if permissions is None:
+            permissions = ROLE_PERMISSIONS[role] if role else []
+        now = int(time.time())
+        payload = {
+            'iss': f'https://{self.domain}/',
+            'sub': f'local|{role or "nobody"}',
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions),
+            **claims
+        }
+        return jwt.encode(payload, self.pem, algorithm=ALGORITHMS[0],
+                          headers={'kid': self.kid})
+
+
+def setup_issuer(app):
+    """Have app trust a LocalIssuer instead of Auth0 if LOCAL_ISSUER is
+    set.  Call before setup_auth.
+
+    LOCAL_ISSUER -> a LocalIssuer, or true for one with the key in
+        LOCAL_ISSUER_KEY (made if missing) or a new key
+    Its jwks is also served at /.well-known/jwks.json.
+
+    Turned on by a flag, which may come from the environment, it is
+    refused unless the app is testing or FLASK_ENV is development, so
+    a stray variable can't make a production server trust it.
+    """
+    issuer = app.config.get('LOCAL_ISSUER')
+    if not isinstance(issuer, LocalIssuer):
+        if not to_bool(issuer or False):
+            app.extensions['local_issuer'] = None
+            return
+        if not (app.testing or app.env == 'development'):
+            raise RuntimeError('LOCAL_ISSUER is only for development, '
+                               'set FLASK_ENV=development')
+        path = app.config.get('LOCAL_ISSUER_KEY')
+        issuer = LocalIssuer.from_file(path) if path else LocalIssuer()
+    app.config['AUTH0_DOMAIN'] = issuer.domain
+    app.config['AUTH0_AUDIENCE'] = issuer.audience
+    app.config['JWKS_FETCHER'] = issuer.jwks
+    app.extensions['local_issuer'] = issuer
+
+    @app.route('/.well-known/jwks.json', methods=['GET'])
+    def local_jwks():
+        return jsonify(issuer.jwks())
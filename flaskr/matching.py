@@ -0,0 +1,403 @@
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple, deque
+from heapq import merge
+from itertools import accumulate, groupby
+from flask import current_app
+from sqlalchemy import and_, exists, func, tuple_
+from sqlalchemy.orm import aliased
+from .models import Actor, Role, Booking, db, versions, on_write
+from .config import to_bool
+
+# candidates returned per role unless the request asks otherwise
+CANDIDATE_LIMIT = 10
+MAX_CANDIDATE_LIMIT = 100
+# widest age difference between an actor and a role that still matches
+MAX_AGE_GAP = 10
+# rows fetched per round trip while building the actor index
+INDEX_BATCH = 10000
+
+ActorRow = namedtuple('ActorRow', Actor.viewable_properties)
+
+
+def candidate_query(role_criteria, max_age_gap=MAX_AGE_GAP,
+                    limit=CANDIDATE_LIMIT):
+    """Return one query ranking the actors for every role matching
+    role_criteria.
+
+    An actor matches a role of the same gender within max_age_gap years
+    unless already booked for a role of the same movie.  The smallest
+    age gap ranks first, ties going to the lower actor id, and each
+    role keeps its first limit candidates.  Rows are the role columns
+    followed by actor_id, actor_name, actor_age, age_gap and rank,
+    ordered by role id and rank.  A role without candidates still gets
+    one row with the actor columns null.
+    """
+    booked_role = aliased(Role)
+    booked = exists().where(and_(
+        Booking.actor_id == Actor.id,
+        Booking.role_id == booked_role.id,
+        booked_role.movie_id == Role.movie_id
+    ))
+    # a range rather than abs() so the gender, age index applies
+    match = and_(
+        Actor.gender == Role.gender,
+        Actor.age >= Role.age - max_age_gap,
+        Actor.age <= Role.age + max_age_gap,
+        ~booked
+    )
+    age_gap = func.abs(Actor.age - Role.age)
+    rank = func.row_number().over(partition_by=Role.id,
+                                  order_by=(age_gap, Actor.id))
+    ranked = db.session.query(
+        *Role.columns(),
+        Actor.id.label('actor_id'),
+        Actor.name.label('actor_name'),
+        Actor.age.label('actor_age'),
+        age_gap.label('age_gap'),
+        rank.label('rank')
+    ).select_from(Role).outerjoin(Actor, match) \
+        .filter(*role_criteria).subquery()
+    return db.session.query(ranked).filter(ranked.c.rank <= limit) \
+        .order_by(ranked.c.id, ranked.c.rank)
+
+
+def group_candidates(rows):
+    """Return [{'role': role, 'candidates': [...]}, ...] from the rows
+    of candidate_query, keeping their order.
+    """
+    nrole_columns = len(Role.viewable_properties)
+    matches = []
+    for row in rows:
+        role = Role.format_row(row[:nrole_columns])
+        if not matches or matches[-1]['role']['id'] != role['id']:
+            matches.append({'role': role, 'candidates': []})
+        if row.actor_id is not None:
+            matches[-1]['candidates'].append({
+                'actor': Actor.format_row(
+                    (row.actor_id, row.actor_name, row.actor_age,
+                     role['gender'])),
+                'age_gap': row.age_gap
+            })
+    return matches
+
+
+def assign_by_age(role_ages, actor_ages, max_age_gap=None):
+    """Match roles to actors one to one by age.
+
+    role_ages -> the roles' ages in ascending order
+    actor_ages -> [(age, number of actors), ...] in ascending age order
+    max_age_gap -> widest age difference allowed, None for any
+
+    Return the age of the actor given to each role, None for the roles
+    left unfilled.  As many roles as possible are filled and of those
+    assignments one with the smallest total age gap is returned.
+
+    Some optimal assignment never gives a younger role an older actor
+    than an older role gets, so each actor age takes a contiguous run
+    of roles.  best[j], the cost of the first j roles using the ages so
+    far, then needs one sliding window minimum per age: O(ages * roles).
+    A skipped role costs more than any assignment could, so filling
+    roles always wins.
+    """
+    nroles = len(role_ages)
+    ages = [age for age, _ in actor_ages]
+    low = min(role_ages[:1] + ages[:1], default=0)
+    high = max(role_ages[-1:] + ages[-1:], default=0)
+    skip = (high - low + 1) * (2 * nroles + 1)
+    best = [j * skip for j in range(nroles + 1)]
+    # per age and j: k when roles k..j-1 get the age, -1 when role j-1
+    # is skipped, j when the age isn't used
+    choices = []
+    for age, count in actor_ages:
+        lo, hi = 0, nroles
+        if max_age_gap is not None:
+            lo = bisect_left(role_ages, age - max_age_gap)
+            hi = bisect_right(role_ages, age + max_age_gap)
+        # gaps[j] -> total age gap of the first j roles to this age
+        gaps = [0, *accumulate(abs(r - age) for r in role_ages)]
+        window = deque()
+        new = []
+        choice = []
+        for j in range(nroles + 1):
+            value = best[j] - gaps[j]
+            while window and window[-1][0] >= value:
+                window.pop()
+            window.append((value, j))
+            start = max(j - count, lo)
+            while window and window[0][1] < start:
+                window.popleft()
+            cost, chosen = best[j], j
+            if j and new[j - 1] + skip < cost:
+                cost, chosen = new[j - 1] + skip, -1
+            if lo < j <= hi and window and window[0][0] + gaps[j] < cost:
+                cost, chosen = window[0][0] + gaps[j], window[0][1]
+            new.append(cost)
+            choice.append(chosen)
+        best = new
+        choices.append(choice)
+
+    assigned = [None] * nroles
+    j = nroles
+    for age, choice in zip(reversed(ages), reversed(choices)):
+        while choice[j] == -1:
+            j -= 1
+        for i in range(choice[j], j):
+            assigned[i] = age
+        j = choice[j]
+    return assigned
+
+
+def autocast(movie_id, max_age_gap=None, for_update=False):
+    """Plan bookings of available actors into the unfilled roles of
+    movie_id with assign_by_age, one gender at a time.
+
+    Available means not booked for a role of the movie, the rule of
+    candidate_query.  Return ([(actor_id, role_id, age_gap), ...]
+    ordered by role id, [unfilled role id, ...]).  for_update locks the
+    roles until the transaction ends.
+    """
+    query = db.session.query(Role.id, Role.gender, Role.age) \
+        .filter(Role.movie_id == movie_id, ~Role.filled) \
+        .order_by(Role.gender, Role.age, Role.id)
+    if for_update:
+        query = query.with_for_update()
+    roles = query.all()
+    booked_role = aliased(Role)
+    available = ~exists().where(and_(
+        Booking.actor_id == Actor.id,
+        Booking.role_id == booked_role.id,
+        booked_role.movie_id == movie_id
+    ))
+    counts = {}
+    if roles:
+        query = db.session.query(Actor.gender, Actor.age, func.count()) \
+            .filter(Actor.gender.in_({r.gender for r in roles}), available) \
+            .group_by(Actor.gender, Actor.age) \
+            .order_by(Actor.gender, Actor.age)
+        for gender, rows in groupby(query, lambda row: row[0]):
+            counts[gender] = [(age, count) for _, age, count in rows]
+
+    # (gender, age) -> the roles given an actor of that age
+    planned = {}
+    unfilled = []
+    for gender, group in groupby(roles, lambda role: role.gender):
+        group = list(group)
+        ages = assign_by_age([r.age for r in group], counts.get(gender, []),
+                             max_age_gap)
+        for role, age in zip(group, ages):
+            if age is None:
+                unfilled.append(role.id)
+            else:
+                planned.setdefault((gender, age), []).append(role)
+
+    bookings = []
+    if planned:
+        rank = func.row_number().over(
+            partition_by=(Actor.gender, Actor.age), order_by=Actor.id)
+        ranked = db.session.query(
+            Actor.id, Actor.gender, Actor.age, rank.label('rank')
+        ).filter(tuple_(Actor.gender, Actor.age).in_(list(planned)),
+                 available).subquery()
+        most = max(map(len, planned.values()))
+        query = db.session.query(ranked.c.id, ranked.c.gender, ranked.c.age) \
+            .filter(ranked.c.rank <= most) \
+            .order_by(ranked.c.gender, ranked.c.age, ranked.c.id)
+        for key, rows in groupby(query, lambda row: (row.gender, row.age)):
+            for role, row in zip(planned[key], rows):
+                bookings.append((row.id, role.id, abs(row.age - role.age)))
+    bookings.sort(key=lambda booking: booking[1])
+    return bookings, sorted(unfilled)
+
+
+class ActorIndex:
+    """The actor table in memory for gender and age lookups.
+
+    For each gender ages[gender][i] and ids[gender][i] are one actor,
+    ordered by age then id, so an age range is two bisects away.  rows
+    maps every id to its ActorRow.
+
+    Writes through the models keep it current (see models.on_write).
+    Writes from other processes are only seen through a shared
+    VERSION_STORE; the index then rebuilds in the background and
+    current() is False until it is done.
+    """
+
+    def __init__(self):
+        self.ages = {}
+        self.ids = {}
+        self.rows = {}
+        self.max_id = 0
+        self.version = None
+        self.lock = threading.RLock()
+        self.rebuilding = None
+
+    def load(self):
+        """Build the index from the actor table.  Needs an app context."""
+        version = versions.current(Actor)
+        ages, ids, rows = {}, {}, {}
+        query = db.session.query(*Actor.columns()) \
+            .order_by(Actor.gender, Actor.age, Actor.id) \
+            .yield_per(INDEX_BATCH)
+        for row in map(ActorRow._make, query):
+            ages.setdefault(row.gender, array('q')).append(row.age)
+            ids.setdefault(row.gender, array('q')).append(row.id)
+            rows[row.id] = row
+        with self.lock:
+            self.ages, self.ids, self.rows = ages, ids, rows
+            self.max_id = max(rows, default=0)
+            self.version = version
+
+    def current(self):
+        """Return whether the index matches the actor table.
+
+        If it doesn't, start rebuilding it in the background.
+        """
+        if self.version == versions.current(Actor):
+            return True
+        self.rebuild(current_app._get_current_object())
+        return False
+
+    def rebuild(self, app):
+        with self.lock:
+            if self.rebuilding is not None and self.rebuilding.is_alive():
+                return
+            self.rebuilding = threading.Thread(
+                target=self.rebuild_in_context, args=(app,), daemon=True)
+            self.rebuilding.start()
+
+    def rebuild_in_context(self, app):
+        with app.app_context():
+            self.load()
+
+    def apply(self, rows, deleted):
+        """Write hook for Actor, see models.on_write."""
+        if rows is None:
+            if deleted:
+                # can't tell which, rebuild
+                self.version = None
+                return
+            # a bulk insert, the new actors have the highest ids
+            query = db.session.query(*Actor.columns()) \
+                .filter(Actor.id > self.max_id)
+            rows = [Actor.format_row(row) for row in query]
+        with self.lock:
+            for row in rows:
+                self.remove(row['id'])
+                if not deleted:
+                    self.insert(ActorRow(**row))
+            # The write bumped the version once.  If something else did
+            # too, it may be a write this index missed: stay stale.
+            if self.version is not None:
+                epoch, count = self.version
+                if versions.current(Actor) == (epoch, count + 1):
+                    self.version = (epoch, count + 1)
+
+    def insert(self, row):
+        ages = self.ages.setdefault(row.gender, array('q'))
+        ids = self.ids.setdefault(row.gender, array('q'))
+        lo = bisect_left(ages, row.age)
+        hi = bisect_right(ages, row.age, lo)
+        i = bisect_left(ids, row.id, lo, hi)
+        ages.insert(i, row.age)
+        ids.insert(i, row.id)
+        self.rows[row.id] = row
+        self.max_id = max(self.max_id, row.id)
+
+    def remove(self, id_):
+        row = self.rows.pop(id_, None)
+        if row is None:
+            return
+        ages, ids = self.ages[row.gender], self.ids[row.gender]
+        lo = bisect_left(ages, row.age)
+        hi = bisect_right(ages, row.age, lo)
+        i = bisect_left(ids, id_, lo, hi)
+        del ages[i]
+        del ids[i]
+
+    def nearest(self, gender, age, max_age_gap=MAX_AGE_GAP,
+                limit=CANDIDATE_LIMIT, exclude=()):
+        """Return up to limit (ActorRow, age gap) pairs for the actors of
+        gender within max_age_gap years of age, leaving out the ids in
+        exclude.  Ranked like candidate_query: smallest gap, then id.
+        """
+        with self.lock:
+            ages = self.ages.get(gender)
+            if not ages:
+                return []
+            ids = self.ids[gender]
+            mid = bisect_left(ages, age)
+            lo = bisect_left(ages, age - max_age_gap, 0, mid)
+            hi = bisect_right(ages, age + max_age_gap, mid)
+
+            def older():
+                for i in range(mid, hi):
+                    yield ages[i] - age, ids[i]
+
+            def younger():
+                # walk down one age at a time, each age's ids ascending
+                i = mid
+                while i > lo:
+                    j = bisect_left(ages, ages[i - 1], lo, i)
+                    for k in range(j, i):
+                        yield age - ages[k], ids[k]
+                    i = j
+
+            found = []
+            for gap, id_ in merge(older(), younger()):
+                if len(found) == limit:
+                    break
+                if id_ not in exclude:
+                    found.append((self.rows[id_], gap))
+            return found
+
+
+def index_candidates(index, role_criteria, max_age_gap=MAX_AGE_GAP,
+                     limit=CANDIDATE_LIMIT):
+    """Return what group_candidates(candidate_query(...)) would, with the
+    actors looked up in index.
+
+    Two queries, for the roles and for the actors already booked in
+    their movies, instead of scanning the actor table.
+    """
+    roles = [Role.format_row(row) for row in
+             db.session.query(*Role.columns()).filter(*role_criteria)
+             .order_by(Role.id)]
+    booked = {}
+    movie_ids = {role['movie_id'] for role in roles}
+    if movie_ids:
+        query = db.session.query(Role.movie_id, Booking.actor_id) \
+            .join(Booking, Booking.role_id == Role.id) \
+            .filter(Role.movie_id.in_(movie_ids))
+        for movie_id, actor_id in query:
+            booked.setdefault(movie_id, set()).add(actor_id)
+    return [{
+        'role': role,
+        'candidates': [
+            {'actor': Actor.format_row(row), 'age_gap': gap}
+            for row, gap in index.nearest(
+                role['gender'], role['age'], max_age_gap, limit,
+                booked.get(role['movie_id'], ()))
+        ]
+    } for role in roles]
+
+
+def setup_index(app):
+    """Build the actor index if ACTOR_INDEX is set and keep it current
+    with the write hooks.  Call after setup_cache.
+
+    Like the response cache it needs a shared VERSION_STORE, or writes
+    made by other processes would never make it stale.
+    """
+    index = None
+    if to_bool(app.config.get('ACTOR_INDEX', False)):
+        if app.extensions.get('shared_versions'):
+            index = ActorIndex()
+            with app.app_context():
+                index.load()
+            on_write(app, Actor, index.apply)
+        else:
+            app.logger.warning('ACTOR_INDEX needs a shared VERSION_STORE, '
+                               'the index is off')
+    app.extensions['actor_index'] = index
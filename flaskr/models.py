@@ -1,8 +1,14 @@
+import sqlite3
+import threading
+from uuid import uuid4
+from collections import defaultdict
 from dateutil.parser import parse
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import (Column, String, Integer, Date,
-                        CheckConstraint, ForeignKey, Boolean)
+                        CheckConstraint, ForeignKey, Boolean, Index, event)
 from sqlalchemy.orm import validates
+from werkzeug.local import LocalProxy
+from .pool import PoolStats, engine_options
 
 db = SQLAlchemy()
 
@@ -11,13 +17,104 @@ class DbTypeError(Exception):
     pass
 
 
+class LocalCounters:
+    """Process local store for the table versions.
+
+    A shared store replacing it needs the same get_many(keys) and
+    incr(key) methods and an epoch attribute.  The epoch tells apart
+    counters that could otherwise repeat, like those of different
+    processes.
+    """
+
+    def __init__(self):
+        self.epoch = uuid4().hex
+        self.counts = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        return [self.counts[k] for k in keys]
+
+    def incr(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+
+class TableVersions:
+    """Change counters per table, bumped by every write path.
+
+    Anything derived from the tables can be keyed on current() and
+    goes stale as soon as one of them is written.
+    """
+
+    def __init__(self, store=None):
+        self.store = store or LocalCounters()
+
+    def current(self, *models):
+        names = [m.__tablename__ for m in models]
+        return (self.store.epoch, *self.store.get_many(names))
+
+    def touch(self, *models):
+        for name in {m.__tablename__ for m in models}:
+            self.store.incr(name)
+
+
+# the current app's TableVersions, see setup_db
+versions = LocalProxy(lambda: db.get_app().extensions['versions'])
+
+def on_write(app, model, hook):
+    """Call hook(rows, deleted) after every committed write to model
+    made under app.
+
+    rows -> formats of the rows written, or None when the write path
+        doesn't know them (bulk inserts, cascades in the database)
+    deleted -> whether the rows were deleted
+    """
+    app.extensions['write_hooks'][model].append(hook)
+
+
+def written(model, rows=None, deleted=False):
+    """Run model's write hooks.
+
+    rows may be a function returning them so writes without hooks
+    don't pay for formatting.
+    """
+    hooks = db.get_app().extensions['write_hooks'].get(model)
+    if not hooks:
+        return
+    if callable(rows):
+        rows = rows()
+    for hook in hooks:
+        hook(rows, deleted)
+
+
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # sqlite only enforces foreign keys, ON DELETE CASCADE included,
+    # when asked to on every connection
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute('PRAGMA foreign_keys=ON')
+
+
 def setup_db(app, database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # pool sizing comes from the DB_POOL_* config keys
+    stats = app.extensions['pool_stats'] = PoolStats()
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {}).update(
+        engine_options(app.config, database_path, stats))
+    # VERSION_STORE shares the table versions between processes
+    app.extensions['versions'] = TableVersions(
+        app.config.get('VERSION_STORE'))
+    # model -> functions called after each committed write, see on_write
+    app.extensions['write_hooks'] = defaultdict(list)
     db.app = app
     db.init_app(app)
-    # this line will be used in case of a test db not set up in migrate
-    db.create_all()
+    # only the app's engine, not every engine in the process
+    event.listen(db.get_engine(app), 'connect', enable_sqlite_foreign_keys)
+    # Production schemas come from the migrations.  Creating tables here
+    # would cost every worker boot a round of reflection queries, so
+    # only tests and explicit DB_CREATE_ALL do it.
+    if app.config.get('DB_CREATE_ALL', app.config.get('TESTING')):
+        db.create_all()
 
 
 def rollback():
@@ -31,21 +128,198 @@ def close_session():
 def add_all(items):
     db.session.add_all(items)
     db.session.commit()
+    models = {type(item) for item in items}
+    versions.touch(*models)
+    for model in models:
+        written(model, lambda: [i.format() for i in items
+                                if type(i) is model])
+
+
+def bulk_insert(model, rows):
+    """Insert rows, a list of column value dicts, in one executemany."""
+    db.session.execute(model.__table__.insert(), rows)
+    db.session.commit()
+    versions.touch(model)
+    written(model)
 
 
 class BaseModel(db.Model):
     __abstract__ = True
+    # cursor pagination orders by (sort_key, id)
+    sort_key = 'id'
+    # largest page a list endpoint will serve
+    max_page_length = 100
+    # relationships list endpoints can embed with ?include=
+    expandable = []
 
     def add(self):
         db.session.add(self)
         db.session.commit()
+        versions.touch(type(self))
+        written(type(self), lambda: [self.format()])
 
-    def format(self):
-        return {p: getattr(self, p) for p in self.viewable_properties}
+    def format(self, include=()):
+        """Return the viewable properties as a dict.
+
+        include -> names from expandable, each added as a list of the
+        related entries' formats
+        """
+        formatted = {p: getattr(self, p) for p in self.viewable_properties}
+        for name in include:
+            formatted[name] = [e.format() for e in getattr(self, name)]
+        return formatted
+
+    @classmethod
+    def columns(cls):
+        """Return the columns behind viewable_properties."""
+        return [getattr(cls, p) for p in cls.viewable_properties]
+
+    @classmethod
+    def format_row(cls, row):
+        """Format a row queried with cls.columns() like format() would."""
+        return dict(zip(cls.viewable_properties, row))
+
+    @classmethod
+    def cascaded(cls):
+        """Return cls and every model a delete of cls cascades to."""
+        models = [cls]
+        for model in models:
+            for rel in model.__mapper__.relationships:
+                if rel.cascade.delete and rel.mapper.class_ not in models:
+                    models.append(rel.mapper.class_)
+        return models
+
+    @classmethod
+    def delete_by_id(cls, id_):
+        """Delete row id_ with one DELETE and return its format, or None
+        if there is no such row.
+
+        The foreign keys cascade the delete to the children in the
+        database, so none of them are loaded.
+
+        The row comes back from DELETE ... RETURNING.  Without RETURNING
+        support, e.g. SQLite, it is read with a SELECT in the same
+        transaction instead.  The other one statement writes below do
+        the same.
+        """
+        statement = cls.__table__.delete().where(cls.id == id_)
+        connection = db.session.connection()
+        if connection.dialect.implicit_returning:
+            row = db.session.execute(
+                statement.returning(*cls.columns())).first()
+        else:
+            row = db.session.query(*cls.columns()) \
+                .filter(cls.id == id_).first()
+            if row is not None:
+                db.session.execute(statement)
+        db.session.commit()
+        if row is None:
+            return None
+        formatted = cls.format_row(row)
+        cls.deleted([formatted])
+        return formatted
 
     def delete(self):
+        formatted = self.format()
         db.session.delete(self)
         db.session.commit()
+        self.deleted([formatted])
+
+    @classmethod
+    def deleted(cls, rows):
+        """Bump the versions and run the write hooks of cls and the
+        models the delete of rows cascaded to.
+        """
+        models = cls.cascaded()
+        versions.touch(*models)
+        written(cls, rows, deleted=True)
+        for model in models[1:]:
+            written(model, deleted=True)
+
+    @classmethod
+    def validated(cls, mapping):
+        """Return mapping's values as the model's validators leave them."""
+        instance = cls(**mapping)
+        return {k: getattr(instance, k) for k in mapping}
+
+    @classmethod
+    def update_by_id(cls, id_, mapping):
+        """Validate mapping and write it to row id_ with one UPDATE.
+
+        Return the row's new format or None if there is no such row.
+        See delete_by_id for databases without RETURNING.
+        """
+        values = cls.validated(mapping)
+        statement = cls.__table__.update().where(cls.id == id_) \
+            .values(**values)
+        connection = db.session.connection()
+        if connection.dialect.implicit_returning:
+            row = db.session.execute(
+                statement.returning(*cls.columns())).first()
+        else:
+            result = db.session.execute(statement)
+            row = None
+            if result.rowcount:
+                row = db.session.query(*cls.columns()) \
+                    .filter(cls.id == id_).first()
+        db.session.commit()
+        if row is None:
+            return None
+        formatted = cls.format_row(row)
+        versions.touch(cls)
+        written(cls, [formatted])
+        return formatted
+
+    @classmethod
+    def update_where(cls, criteria, mapping):
+        """Validate mapping and write it to every row matching criteria
+        with one UPDATE.  Return the rows' new formats ordered by id.
+        See delete_by_id for databases without RETURNING.
+        """
+        values = cls.validated(mapping)
+        statement = cls.__table__.update().values(**values)
+        connection = db.session.connection()
+        if connection.dialect.implicit_returning:
+            for criterion in criteria:
+                statement = statement.where(criterion)
+            rows = db.session.execute(
+                statement.returning(*cls.columns())).fetchall()
+        else:
+            ids = [r.id for r in db.session.query(cls.id).filter(*criteria)]
+            rows = []
+            if ids:
+                db.session.execute(statement.where(cls.id.in_(ids)))
+                rows = db.session.query(*cls.columns()) \
+                    .filter(cls.id.in_(ids)).all()
+        db.session.commit()
+        formatted = sorted(map(cls.format_row, rows), key=lambda r: r['id'])
+        if formatted:
+            versions.touch(cls)
+            written(cls, formatted)
+        return formatted
+
+    @classmethod
+    def delete_where(cls, criteria):
+        """Delete every row matching criteria with one DELETE and return
+        their formats ordered by id.  See delete_by_id for the cascade
+        and for databases without RETURNING.
+        """
+        statement = cls.__table__.delete()
+        for criterion in criteria:
+            statement = statement.where(criterion)
+        connection = db.session.connection()
+        if connection.dialect.implicit_returning:
+            rows = db.session.execute(
+                statement.returning(*cls.columns())).fetchall()
+        else:
+            rows = db.session.query(*cls.columns()).filter(*criteria).all()
+            if rows:
+                db.session.execute(statement)
+        db.session.commit()
+        formatted = sorted(map(cls.format_row, rows), key=lambda r: r['id'])
+        if formatted:
+            cls.deleted(formatted)
+        return formatted
 
     def update(self, mapping=None, **kwargs):
         if mapping is None:
@@ -53,6 +327,8 @@ class BaseModel(db.Model):
         for k, v in mapping.items():
             setattr(self, k, v)
         db.session.commit()
+        versions.touch(type(self))
+        written(type(self), lambda: [self.format()])
 
     @validates('age')
     def validate_age(self, key, age):
@@ -60,7 +336,7 @@ class BaseModel(db.Model):
             age = int(age)
             assert age > 0
             return age
-        except (ValueError, AssertionError):
+        except (ValueError, TypeError, AssertionError):
             raise DbTypeError
 
     @validates('gender')
@@ -84,6 +360,8 @@ class BaseModel(db.Model):
 class Actor(BaseModel):
     __tablename__ = 'actor'
     viewable_properties = ['id', 'name', 'age', 'gender']
+    sort_key = 'name'
+    expandable = ['bookings']
 
     id = Column(Integer, primary_key=True)
     name = Column(String(50), nullable=False)
@@ -91,8 +369,15 @@ class Actor(BaseModel):
     gender = Column(String(15),
                     CheckConstraint("gender in ('male', 'female', 'non')"),
                     nullable=False)
+    # the database deletes the bookings, see delete_by_id
     bookings = db.relationship('Booking', backref='actor', lazy=True,
-                               cascade='all, delete-orphan')
+                               cascade='all, delete-orphan',
+                               passive_deletes=True)
+
+    __table_args__ = (
+        Index('ix_actor_gender_age', 'gender', 'age'),
+        Index('ix_actor_name_id', 'name', 'id'),
+    )
 
     def __repr__(self):
         return f'<Actor {self.id} {self.name}>'
@@ -101,12 +386,19 @@ class Actor(BaseModel):
 class Movie(BaseModel):
     __tablename__ = 'movie'
     viewable_properties = ['id', 'title', 'release_date']
+    sort_key = 'release_date'
+    expandable = ['roles']
 
     id = Column(Integer, primary_key=True)
     title = Column(String(100), nullable=False)
     release_date = Column(Date, nullable=False)
     roles = db.relationship('Role', backref='movie', lazy=True,
-                            cascade='all, delete-orphan')
+                            cascade='all, delete-orphan',
+                            passive_deletes=True)
+
+    __table_args__ = (
+        Index('ix_movie_release_date', 'release_date'),
+    )
 
     def __repr__(self):
         return f'<Move {self.id} {self.title}>'
@@ -123,6 +415,8 @@ class Movie(BaseModel):
 class Role(BaseModel):
     __tablename__ = 'role'
     viewable_properties = ['id', 'name', 'age', 'gender', 'filled', 'movie_id']
+    sort_key = 'movie_id'
+    max_page_length = 250
 
     id = Column(Integer, primary_key=True)
     name = Column(String(50), nullable=False)
@@ -131,7 +425,17 @@ class Role(BaseModel):
                     CheckConstraint("gender in ('male', 'female', 'non')"),
                     nullable=False)
     filled = Column(Boolean, nullable=False, default=False)
-    movie_id = Column(Integer, ForeignKey('movie.id'), nullable=False)
+    movie_id = Column(Integer, ForeignKey('movie.id', ondelete='CASCADE'),
+                      nullable=False)
+    bookings = db.relationship('Booking', backref='role', lazy=True,
+                               cascade='all, delete-orphan',
+                               passive_deletes=True)
+
+    __table_args__ = (
+        Index('ix_role_movie_id', 'movie_id'),
+        Index('ix_role_gender_age', 'gender', 'age'),
+        Index('ix_role_filled_gender_age', 'filled', 'gender', 'age'),
+    )
 
     def __repr__(self):
         return f'<Role {self.id} {self.name}>'
@@ -143,9 +447,37 @@ class Booking(BaseModel):
     viewable_properties = ['id', 'actor_id', 'role_id']
 
     id = Column(Integer, primary_key=True)
-    role_id = Column(Integer, ForeignKey('role.id'), nullable=False)
-    actor_id = Column(Integer, ForeignKey('actor.id'), nullable=False)
+    role_id = Column(Integer, ForeignKey('role.id', ondelete='CASCADE'),
+                     nullable=False)
+    actor_id = Column(Integer, ForeignKey('actor.id', ondelete='CASCADE'),
+                      nullable=False)
+
+    __table_args__ = (
+        Index('ix_booking_actor_id', 'actor_id'),
+        Index('ix_booking_role_id', 'role_id'),
+    )
 
     def __repr__(self):
         return (f'<Booking {self.id}'
                 'role({self.role_id}) actor({self.actor_id})>')
+
+    @classmethod
+    def book_all(cls, pairs):
+        """Book each (actor_id, role_id) pair in one transaction.
+
+        The roles are marked filled with a single UPDATE and the
+        bookings inserted with one executemany.
+        """
+        if not pairs:
+            return
+        role_ids = [role_id for _, role_id in pairs]
+        Role.query.filter(Role.id.in_(role_ids)).update(
+            {'filled': True}, synchronize_session=False)
+        db.session.execute(cls.__table__.insert(), [
+            {'actor_id': actor_id, 'role_id': role_id}
+            for actor_id, role_id in pairs
+        ])
+        db.session.commit()
+        versions.touch(Role, cls)
+        written(Role)
+        written(cls)
@@ -0,0 +1,119 @@
+import threading
+import time
+from bisect import bisect_left
+from sqlalchemy.pool import QueuePool
+from .encoders import jsonify
+from .config import to_bool
+from .auth import requires_auth, requires_auth_dummy, STATS_PERMISSION
+
+# app config key -> (create_engine argument, type)
+POOL_CONFIG = {
+    'DB_POOL_SIZE': ('pool_size', int),
+    'DB_MAX_OVERFLOW': ('max_overflow', int),
+    'DB_POOL_TIMEOUT': ('pool_timeout', float),
+    'DB_POOL_RECYCLE': ('pool_recycle', int),
+    'DB_POOL_PRE_PING': ('pool_pre_ping', bool),
+}
+# arguments only the queue pool used for servers like postgres takes
+QUEUE_POOL_ARGS = {'pool_size', 'max_overflow', 'pool_timeout'}
+
+# upper bounds in seconds of the checkout wait histogram buckets
+WAIT_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, float('inf')]
+
+
+class PoolStats:
+    """Histogram of how long checkouts waited for a connection."""
+
+    def __init__(self, buckets=WAIT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def record_wait(self, seconds):
+        with self.lock:
+            self.counts[bisect_left(self.buckets, seconds)] += 1
+            self.total += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'checkouts': sum(self.counts),
+                'wait_seconds_total': self.total,
+                'wait_histogram': [
+                    {'le': str(bound), 'count': count}
+                    for bound, count in zip(self.buckets, self.counts)
+                ]
+            }
+
+
+def timed_pool_class(stats):
+    """Return a QueuePool recording each checkout's wait in stats.
+
+    The wait includes opening a new connection when the pool has to.
+    The pool events only fire once a connection is handed out, so this
+    overrides QueuePool._do_get, which is private: requirements.txt pins
+    SQLAlchemy, and an upgrade without it is refused here rather than
+    leaving the histogram empty.
+    """
+    if not hasattr(QueuePool, '_do_get'):
+        raise RuntimeError('POOL_STATS needs QueuePool._do_get, check the '
+                           'SQLAlchemy version in requirements.txt')
+
+    class TimedQueuePool(QueuePool):
+        def _do_get(self):
+            start = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                stats.record_wait(time.perf_counter() - start)
+    return TimedQueuePool
+
+
+def engine_options(config, database_path, stats):
+    """Return the create_engine arguments set by the DB_* config keys.
+
+    SQLite keeps its own pool, so it only gets pre ping and recycle.
+    """
+    options = {}
+    for key, (arg, type_) in POOL_CONFIG.items():
+        if config.get(key) is not None:
+            options[arg] = (to_bool if type_ is bool else type_)(config[key])
+    if database_path.startswith('sqlite'):
+        return {k: v for k, v in options.items()
+                if k not in QUEUE_POOL_ARGS}
+    options['poolclass'] = timed_pool_class(stats)
+    return options
+
+
+def pool_status(pool, stats):
+    status = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow()
+        })
+    status.update(stats.snapshot())
+    return status
+
+
+def register_views(app, db):
+    """Serve the pool stats at /_internal/pool to tokens with the
+    view:stats permission.
+
+    Only call this when the app should expose them (POOL_STATS).
+    """
+    if app.config.get('TESTING_WITHOUT_AUTH'):
+        auth = requires_auth_dummy
+    else:
+        auth = requires_auth
+
+    @app.route('/_internal/pool', methods=['GET'])
+    @auth(STATS_PERMISSION)
+    def get_pool_stats(jwt_payload):
+        return jsonify({
+            'success': True,
+            **pool_status(db.engine.pool, app.extensions['pool_stats'])
+        })
@@ -1,4 +1,6 @@
-from flask_script import Manager
+import sys
+
+from flask_script import Manager, Command, Option
 from flask_migrate import Migrate, MigrateCommand
 
 from flaskr import create_app
@@ -11,5 +13,35 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+class CreateDb(Command):
+    """Create any missing tables without going through the migrations."""
+
+    def run(self):
+        db.create_all()
+
+
+manager.add_command('create_db', CreateDb())
+
+
+class MintToken(Command):
+    """Print a token signed by the local issuer (LOCAL_ISSUER) for a role.
+    Set LOCAL_ISSUER_KEY so the server trusts the same key.
+    """
+
+    option_list = (
+        Option('role', choices=['assistant', 'director', 'producer']),
+        Option('--expires-in', dest='expires_in', type=int, default=3600),
+    )
+
+    def run(self, role, expires_in):
+        issuer = app.extensions['local_issuer']
+        if issuer is None:
+            sys.exit('LOCAL_ISSUER is not set')
+        print(issuer.mint(role, expires_in=expires_in))
+
+
+manager.add_command('mint_token', MintToken())
+
+
 if __name__ == '__main__':
     manager.run()
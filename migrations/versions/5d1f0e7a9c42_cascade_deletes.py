@@ -0,0 +1,61 @@
+"""foreign keys cascade deletes
+
+Revision ID: 5d1f0e7a9c42
+Revises: b86fe9a73c39
+Create Date: 2026-10-17 15:41:08.226193
+
+The constraint names are the ones postgres gave the unnamed foreign
+keys of the initial schema.  SQLite can't alter constraints, so there
+the tables are copied into new ones, with the reflected foreign keys
+given the same names.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d1f0e7a9c42'
+down_revision = 'b86fe9a73c39'
+branch_labels = None
+depends_on = None
+
+# (table, column, referred table)
+FOREIGN_KEYS = [
+    ('role', 'movie_id', 'movie'),
+    ('booking', 'role_id', 'role'),
+    ('booking', 'actor_id', 'actor'),
+]
+
+
+NAMING_CONVENTION = {'fk': '%(table_name)s_%(column_0_name)s_fkey'}
+
+
+def check_constraints(table):
+    # sqlite doesn't reflect CHECK constraints, the copy needs them again
+    if table != 'role':
+        return ()
+    return (sa.CheckConstraint('age > 0'),
+            sa.CheckConstraint("gender in ('male', 'female', 'non')"))
+
+
+def recreate_foreign_keys(ondelete, foreign_keys):
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    for table, column, referred in foreign_keys:
+        name = f'{table}_{column}_fkey'
+        with op.batch_alter_table(
+                table, recreate='always' if sqlite else 'auto',
+                naming_convention=NAMING_CONVENTION,
+                table_args=check_constraints(table)) as batch_op:
+            batch_op.drop_constraint(name, type_='foreignkey')
+            batch_op.create_foreign_key(name, referred, [column], ['id'],
+                                        ondelete=ondelete)
+
+
+def upgrade():
+    recreate_foreign_keys('CASCADE', FOREIGN_KEYS)
+
+
+def downgrade():
+    # children first, so no cascade is left pointing at a table while
+    # it is being copied
+    recreate_foreign_keys(None, reversed(FOREIGN_KEYS))
@@ -0,0 +1,39 @@
+"""indexes for the list filters and foreign keys
+
+Revision ID: b86fe9a73c39
+Revises: c644125b69d4
+Create Date: 2026-10-17 10:14:37.902551
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b86fe9a73c39'
+down_revision = 'c644125b69d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_actor_gender_age', 'actor', ['gender', 'age'])
+    op.create_index('ix_actor_name_id', 'actor', ['name', 'id'])
+    op.create_index('ix_movie_release_date', 'movie', ['release_date'])
+    op.create_index('ix_role_movie_id', 'role', ['movie_id'])
+    op.create_index('ix_role_gender_age', 'role', ['gender', 'age'])
+    op.create_index('ix_role_filled_gender_age', 'role',
+                    ['filled', 'gender', 'age'])
+    op.create_index('ix_booking_actor_id', 'booking', ['actor_id'])
+    op.create_index('ix_booking_role_id', 'booking', ['role_id'])
+
+
+def downgrade():
+    op.drop_index('ix_booking_role_id', table_name='booking')
+    op.drop_index('ix_booking_actor_id', table_name='booking')
+    op.drop_index('ix_role_filled_gender_age', table_name='role')
+    op.drop_index('ix_role_gender_age', table_name='role')
+    op.drop_index('ix_role_movie_id', table_name='role')
+    op.drop_index('ix_movie_release_date', table_name='movie')
+    op.drop_index('ix_actor_name_id', table_name='actor')
+    op.drop_index('ix_actor_gender_age', table_name='actor')
@@ -0,0 +1,68 @@
+"""initial schema
+
+Revision ID: c644125b69d4
+Revises: 
+Create Date: 2026-10-17 10:02:11.418207
+
+Databases whose tables were made by db.create_all() already have this
+schema.  Mark them with `python manage.py db stamp c644125b69d4` before
+upgrading.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c644125b69d4'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'actor',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=50), nullable=False),
+        sa.Column('age', sa.Integer(), nullable=False),
+        sa.Column('gender', sa.String(length=15), nullable=False),
+        sa.CheckConstraint('age > 0'),
+        sa.CheckConstraint("gender in ('male', 'female', 'non')"),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'movie',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('title', sa.String(length=100), nullable=False),
+        sa.Column('release_date', sa.Date(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'role',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=50), nullable=False),
+        sa.Column('age', sa.Integer(), nullable=False),
+        sa.Column('gender', sa.String(length=15), nullable=False),
+        sa.Column('filled', sa.Boolean(), nullable=False),
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.CheckConstraint('age > 0'),
+        sa.CheckConstraint("gender in ('male', 'female', 'non')"),
+        sa.ForeignKeyConstraint(['movie_id'], ['movie.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'booking',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('role_id', sa.Integer(), nullable=False),
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['actor_id'], ['actor.id'], ),
+        sa.ForeignKeyConstraint(['role_id'], ['role.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('booking')
+    op.drop_table('role')
+    op.drop_table('movie')
+    op.drop_table('actor')
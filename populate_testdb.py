@@ -57,6 +57,8 @@ def do_it(db_url, app=None):
         app = create_app({'DATABASE_URL': db_url})
 
     with app.app_context():
+        # in case of a test db not set up in migrate
+        db.create_all()
         session = db.session
         # first delete anything left in there
         for model in [Booking, Role, Actor, Movie]:
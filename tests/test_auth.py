@@ -1,16 +1,30 @@
 import os
+import json
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
 import pytest
+from flask import Flask
 from flaskr import create_app
-import jwts
+from flaskr.auth import (JWKSCache, TokenCache, AuthError, file_fetcher,
+                         url_fetcher, construct_key, check_permissions,
+                         verify_token, register_views, setup_auth,
+                         AUTH0_SETTINGS)
+from flaskr.issuer import LocalIssuer, ROLE_PERMISSIONS, setup_issuer
 import populate_testdb
 
+# signs the tests' tokens in place of Auth0, 1024 bits to keep it quick
+ISSUER = LocalIssuer(bits=1024)
+
 
 @pytest.fixture(scope='module')
 def client():
     dburl = 'sqlite:///:memory:'
     app = create_app({
         'TESTING': True,
-        'DATABASE_URL': dburl
+        'DATABASE_URL': dburl,
+        'LOCAL_ISSUER': ISSUER,
+        'POOL_STATS': True
     })
     populate_testdb.do_it(dburl, app)
     with app.app_context():
@@ -18,10 +32,11 @@ def client():
 
 
 HEADERS = {
-    'assistant': f'Authorization: Bearer {jwts.ASSISTANT}',
-    'director': f'Authorization: Bearer {jwts.DIRECTOR}',
-    'producer': f'Authorization: Bearer {jwts.PRODUCER}',
-    'expired': f'Authorization: Bearer {jwts.EXPIRED}',
+    'assistant': f'Authorization: Bearer {ISSUER.mint("assistant")}',
+    'director': f'Authorization: Bearer {ISSUER.mint("director")}',
+    'producer': f'Authorization: Bearer {ISSUER.mint("producer")}',
+    'expired':
+        f'Authorization: Bearer {ISSUER.mint("producer", expires_in=-10)}',
     'irrelevant': 'Authorization: I want in!!!'
 }
 
@@ -138,3 +153,344 @@ def test_book_actor_role(client):
 def test_post_roles(client):
     url = '/roles/1'
     check('director', client.post, url)
+
+
+def test_internal_stats(client):
+    # success
+    # -------------------------------------------------
+    url = '/_internal/pool'
+    token = ISSUER.mint(permissions=['view:stats'])
+    response = client.get(url, headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+    assert 'checkouts' in response.json
+
+    # the token cache counts the requests it answered
+    url = '/_internal/token_cache'
+    response = client.get(url, headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200
+    hits = response.json['hits']
+    response = client.get(url, headers={'Authorization': f'Bearer {token}'})
+    assert response.json['hits'] == hits + 1
+    assert response.json['size'] >= 1
+
+    # fail with 401 without view:stats
+    # -------------------------------------------------
+    for url in ['/_internal/pool', '/_internal/token_cache']:
+        response = client.get(url, headers=header('producer'))
+        assert response.status_code == 401
+        response = client.get(url)
+        assert response.status_code == 401
+
+
+def test_login_views():
+    # only registered with the whole Auth0 application configured
+    settings = {'AUTH0_DOMAIN': 'casting.auth0.com', 'AUTH0_AUDIENCE': 'a',
+                'AUTH0_CLIENT_ID': 'c', 'AUTH0_CALLBACK_URL': 'http://cb'}
+    app = Flask(__name__)
+    app.config.update(settings)
+    register_views(app)
+    response = app.test_client().get('/login')
+    assert response.status_code == 302
+    assert response.location.startswith(
+        'https://casting.auth0.com/authorize?audience=a&')
+
+    app = Flask(__name__)
+    app.config.update(settings, AUTH0_DOMAIN=None)
+    register_views(app)
+    assert app.test_client().get('/login').status_code == 404
+
+
+# JWKSCache
+# -------------------------------------------------
+
+JWKS = {'keys': [{'kid': 'a', 'kty': 'RSA', 'use': 'sig', 'n': 'n', 'e': 'e'}]}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def counting_fetcher(documents):
+    # documents -> list of jwks documents or exceptions, served in order
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        doc = documents[min(len(calls), len(documents)) - 1]
+        if isinstance(doc, Exception):
+            raise doc
+        return doc
+    return fetch, calls
+
+
+def test_jwks_cache_ttl():
+    fetch, calls = counting_fetcher([JWKS])
+    clock = FakeClock()
+    cache = JWKSCache(fetch, ttl=10, min_refetch_interval=5, clock=clock)
+    assert cache.get_key('a')['kid'] == 'a'
+    assert cache.get_key('a')
+    assert len(calls) == 1
+
+    clock.now = 10
+    assert cache.get_key('a')
+    assert len(calls) == 2
+
+
+def test_jwks_cache_kid_miss():
+    rotated = {'keys': JWKS['keys'] + [dict(JWKS['keys'][0], kid='b')]}
+    fetch, calls = counting_fetcher([JWKS, rotated])
+    clock = FakeClock()
+    cache = JWKSCache(fetch, ttl=100, min_refetch_interval=5, clock=clock)
+    cache.get_key('a')
+
+    # unknown kids only trigger a fetch once per interval
+    assert cache.get_key('nope') is None
+    assert cache.get_key('nope') is None
+    assert len(calls) == 1
+
+    clock.now = 5
+    assert cache.get_key('b')['kid'] == 'b'
+    assert len(calls) == 2
+
+
+def test_jwks_cache_stale_on_failure():
+    fetch, calls = counting_fetcher([JWKS, OSError('down')])
+    clock = FakeClock()
+    cache = JWKSCache(fetch, ttl=10, min_refetch_interval=5, clock=clock)
+    cache.get_key('a')
+
+    clock.now = 20
+    assert cache.get_key('a')
+    assert len(calls) == 2
+    # failed refreshes are rate limited too
+    assert cache.get_key('a')
+    assert len(calls) == 2
+
+    # nothing to fall back on
+    fetch, calls = counting_fetcher([OSError('down'), OSError('down'), JWKS])
+    cache = JWKSCache(fetch, min_refetch_interval=5, clock=clock)
+    with pytest.raises(AuthError):
+        cache.get_key('a')
+    # and no fetch before the interval is up
+    with pytest.raises(AuthError) as error:
+        cache.get_key('a')
+    assert error.value.code == 503
+    assert len(calls) == 1
+
+    clock.now += 5
+    with pytest.raises(AuthError):
+        cache.get_key('a')
+    clock.now += 5
+    assert cache.get_key('a')
+    assert len(calls) == 3
+
+
+def test_jwks_file_fetcher(tmp_path):
+    path = tmp_path / 'jwks.json'
+    path.write_text(json.dumps(JWKS))
+    cache = JWKSCache(file_fetcher(str(path)))
+    assert cache.get_key('a') == JWKS['keys'][0]
+
+
+# Background refresher
+# -------------------------------------------------
+
+class StubJWKSHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.hits += 1
+        body = json.dumps(self.server.jwks).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def jwks_server():
+    # stands in for Auth0's jwks endpoint, counting the fetches
+    server = HTTPServer(('127.0.0.1', 0), StubJWKSHandler)
+    server.jwks = ISSUER.jwks()
+    server.hits = 0
+    server.url = f'http://127.0.0.1:{server.server_port}/jwks.json'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_jwks_background_refresh(jwks_server):
+    cache = JWKSCache(url_fetcher(jwks_server.url), ttl=0.5,
+                      min_refetch_interval=0.05, parse=construct_key)
+    cache.start(margin=0.3)
+    # the first request waits for the first fetch, the key comes parsed
+    key = cache.get_key('local')
+    assert key is not None and not isinstance(key, dict)
+
+    # requests never fetch
+    hits = jwks_server.hits
+    for _ in range(10):
+        assert cache.get_key('local') is key
+    assert jwks_server.hits == hits
+
+    # refetched before the keys go stale
+    fetched_at = cache.fetched_at
+    wait_for(lambda: jwks_server.hits > hits)
+    wait_for(lambda: cache.fetched_at != fetched_at)
+    assert cache.fetched_at - fetched_at < cache.ttl
+
+    # an unknown kid wakes the refresher up
+    jwk = ISSUER.jwks()['keys'][0]
+    jwks_server.jwks = {'keys': [jwk, dict(jwk, kid='rotated')]}
+    wait_for(lambda: cache.get_key('rotated') is not None)
+
+
+def test_jwks_refresher_starts_lazily():
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return ISSUER.jwks()
+
+    app = Flask(__name__)
+    app.config.update({k: 'x' for k in AUTH0_SETTINGS}, JWKS_FETCHER=fetch)
+    setup_auth(app)
+    cache = app.extensions['jwks_cache']
+    # nothing fetched just for creating the app
+    assert cache.thread is None and calls == []
+    assert cache.get_key('local') is not None
+    assert cache.thread.is_alive() and calls == [1]
+
+
+def test_verify_prefetched_key(client, jwks_server, monkeypatch):
+    app = client.application
+    cache = JWKSCache(url_fetcher(jwks_server.url), parse=construct_key)
+    cache.start()
+    monkeypatch.setitem(app.extensions, 'jwks_cache', cache)
+    monkeypatch.setitem(app.extensions, 'token_cache', TokenCache())
+
+    token = ISSUER.mint('assistant')
+    with app.app_context():
+        payload, permissions = verify_token(token)
+        assert payload['sub'] == 'local|assistant'
+        assert permissions == frozenset(ROLE_PERMISSIONS['assistant'])
+
+        # somebody else's claims under this signature
+        header, _, signature = token.split('.')
+        forged = ISSUER.mint('producer').split('.')[1]
+        with pytest.raises(AuthError):
+            verify_token('.'.join([header, forged, signature]))
+
+        with pytest.raises(AuthError) as error:
+            verify_token(ISSUER.mint('assistant', expires_in=-10))
+        assert error.value.name == 'token_expired'
+
+        with pytest.raises(AuthError) as error:
+            verify_token(ISSUER.mint('assistant', aud='elsewhere'))
+        assert error.value.name == 'invalid_claims'
+
+        # a key Auth0 never published
+        stranger = LocalIssuer(bits=1024)
+        with pytest.raises(AuthError):
+            verify_token(stranger.mint('producer'))
+    assert jwks_server.hits == 1
+
+
+# LocalIssuer
+# -------------------------------------------------
+
+def test_local_jwks(client):
+    response = client.get('/.well-known/jwks.json')
+    assert response.status_code == 200
+    assert response.get_json() == ISSUER.jwks()
+
+
+def test_local_issuer_refused(tmp_path):
+    # a flag from the environment only counts in development
+    path = tmp_path / 'issuer.pem'
+    path.write_text(ISSUER.pem)
+    settings = {'LOCAL_ISSUER': '1', 'LOCAL_ISSUER_KEY': str(path)}
+    app = Flask(__name__)
+    app.config.update(settings, ENV='production')
+    with pytest.raises(RuntimeError):
+        setup_issuer(app)
+
+    app = Flask(__name__)
+    app.config.update(settings, ENV='development')
+    setup_issuer(app)
+    assert app.extensions['local_issuer'].jwks() == ISSUER.jwks()
+
+
+def test_issuer_key_file(tmp_path):
+    path = str(tmp_path / 'issuer.pem')
+    issuer = LocalIssuer.from_file(path, bits=1024)
+    # workers pointed at the same file share the key
+    assert LocalIssuer.from_file(path).jwks() == issuer.jwks()
+
+    jwks_path = tmp_path / 'jwks.json'
+    issuer.write_jwks(str(jwks_path))
+    cache = JWKSCache(file_fetcher(str(jwks_path)), parse=construct_key)
+    header, payload, signature = issuer.mint('director').split('.')
+    from jose.utils import base64url_decode
+    key = cache.get_key('local')
+    assert key.verify(f'{header}.{payload}'.encode(),
+                      base64url_decode(signature.encode()))
+
+
+# TokenCache
+# -------------------------------------------------
+
+def test_token_cache():
+    clock = FakeClock()
+    cache = TokenCache(maxsize=2, clock=clock)
+    perms = frozenset(['view:actors'])
+    cache.set('t1', {'exp': 10}, perms)
+    cache.set('t2', {'exp': 20}, perms)
+    assert cache.get('t1') == ({'exp': 10}, perms)
+    assert cache.get('nope') is None
+
+    # t2 is least recently used
+    cache.set('t3', {'exp': 30}, perms)
+    assert cache.get('t2') is None
+    assert cache.get('t3')
+
+    # expired tokens are evicted
+    clock.now = 10
+    assert cache.get('t1') is None
+    assert cache.stats() == {'hits': 2, 'misses': 3, 'size': 1}
+
+    # no exp, no caching
+    cache.set('t4', {}, perms)
+    assert cache.get('t4') is None
+
+
+def test_check_permissions():
+    granted = frozenset(['view:actors', 'view:movies'])
+    assert check_permissions(frozenset(), None)
+    assert check_permissions(frozenset(['view:actors']), granted)
+    assert check_permissions(
+        frozenset(['view:actors', 'view:movies']), granted)
+    assert check_permissions(
+        frozenset(['add:actors', 'view:movies']), granted, any_of=True)
+
+    for required, any_of in [(['add:actors', 'view:movies'], False),
+                             (['add:actors', 'add:movies'], True)]:
+        with pytest.raises(AuthError):
+            check_permissions(frozenset(required), granted, any_of)
+
+    with pytest.raises(AuthError):
+        check_permissions(frozenset(['view:actors']), None)
@@ -1,9 +1,22 @@
 import os
+import json
+from base64 import urlsafe_b64encode
+from contextlib import contextmanager
 from datetime import timedelta
 from itertools import chain
 import pytest
+from flask import Flask, jsonify
+from sqlalchemy import event, create_engine
 from flaskr import create_app
-from flaskr.models import Movie, Actor, Role
+from flaskr.models import (Movie, Actor, Role, Booking, db, versions,
+                           LocalCounters, TableVersions)
+from flaskr.matching import (ActorIndex, ActorRow, candidate_query,
+                             group_candidates, index_candidates,
+                             assign_by_age, setup_index)
+from flaskr.encoders import StdlibEncoder, OrjsonEncoder
+from flaskr.controllers import filter_release_dates
+from flaskr.cache import setup_cache, cached
+from flaskr.pool import PoolStats, engine_options, pool_status
 import populate_testdb
 
 
@@ -13,7 +26,9 @@ def client():
     app = create_app({
         'TESTING': True,
         'DATABASE_URL': dburl,
-        'TESTING_WITHOUT_AUTH': True
+        'TESTING_WITHOUT_AUTH': True,
+        # one process, so its own counters are shared by every writer
+        'VERSION_STORE': LocalCounters()
     })
     populate_testdb.do_it(dburl, app)
 
@@ -78,6 +93,21 @@ BAD_ID = 999
 BAD_PAGE = 999
 
 
+@contextmanager
+def count_queries():
+    # yields a list that collects every statement sent to the database
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+
+
 # Test the GETs first before messing with the data
 
 def test_get_movies(client):
@@ -113,6 +143,35 @@ def test_get_movie(client):
     assert response.status_code == 404
 
 
+def test_eager_loading(client, monkeypatch):
+    # success
+    # -------------------------------------------------
+    monkeypatch.setitem(client.application.extensions, 'response_cache', None)
+    movie_id = Movie.query.first().id
+    with count_queries() as statements:
+        response = client.get(f'/movie/{movie_id}')
+    assert response.status_code == 200
+    assert len(statements) == 1
+
+    # roles for the whole page come in one extra query
+    with count_queries() as statements:
+        response = client.get('/movies', query_string={'include': 'roles'})
+    assert response.status_code == 200
+    assert len(statements) == 2
+    movies = response.json['movies']
+    assert sum(len(m['roles']) for m in movies) == Role.query.count()
+    assert all(r['movie_id'] == m['id'] for m in movies for r in m['roles'])
+
+    response = client.get('/actors', query_string={'include': 'bookings'})
+    assert response.status_code == 200
+    assert all('bookings' in a for a in response.json['actors'])
+
+    # fail with 422 unknown relationship
+    # -------------------------------------------------
+    response = client.get('/actors', query_string={'include': 'roles'})
+    assert response.status_code == 422
+
+
 def test_get_actors(client):
     #
     # success
@@ -242,6 +301,280 @@ def test_get_roles(client):
     assert response.status_code == 422
 
 
+def test_page_bounds(client, monkeypatch):
+    # success
+    # -------------------------------------------------
+    url = '/actors'
+    nactors = Actor.query.count()
+    response = client.get(url, query_string={'page_length': nactors})
+    assert len(response.json['actors']) == nactors
+    assert response.json['next_page'] is None
+
+    response = client.get(url, query_string={'page_length': nactors - 1})
+    assert response.json['next_page'] == 2
+
+    # page_length is capped at the model's maximum
+    monkeypatch.setattr(Actor, 'max_page_length', 2)
+    response = client.get(url, query_string={'page_length': 1000000})
+    assert response.status_code == 200
+    assert len(response.json['actors']) == 2
+    response = client.get(url, query_string={'page_length': 1000000,
+                                             'after': ''})
+    assert len(response.json['actors']) == 2
+
+    # fail with 422 nonsense page numbers
+    # -------------------------------------------------
+    for query_string in [{'page': 0}, {'page_length': -1}]:
+        response = client.get(url, query_string=query_string)
+        assert response.status_code == 422
+
+
+def test_get_cursor_pages(client):
+    # success
+    # -------------------------------------------------
+    # walk every model with a small page length and make sure each
+    # entry shows up exactly once
+    for url, model in [('/actors', Actor), ('/movies', Movie),
+                       ('/roles', Role)]:
+        key = model.plural()
+        query_string = {'page_length': 3, 'after': ''}
+        seen = []
+        while True:
+            response = client.get(url, query_string=query_string)
+            assert response.status_code == 200
+            assert len(response.json[key]) <= 3
+            seen += [e['id'] for e in response.json[key]]
+            if response.json['next_cursor'] is None:
+                break
+            query_string['after'] = response.json['next_cursor']
+        assert sorted(seen) == sorted(e.id for e in model.query.all())
+
+    # filters still apply
+    query_string = {'gender': 'female', 'page_length': 2, 'after': ''}
+    response = client.get('/actors', query_string=query_string)
+    assert all(a['gender'] == 'female' for a in response.json['actors'])
+    assert response.json['next_cursor']
+
+    # fail with 422 malformed cursor
+    # -------------------------------------------------
+    response = client.get('/actors', query_string={'after': 'garbage'})
+    assert response.status_code == 422
+
+    # fail with 422 cursor value of the wrong type
+    # -------------------------------------------------
+    for url, value in [('/actors', [1]), ('/roles', 'four'),
+                       ('/movies', 20200101)]:
+        cursor = urlsafe_b64encode(json.dumps([value, 1]).encode())
+        response = client.get(url, query_string={'after': cursor.decode()})
+        assert response.status_code == 422
+
+
+def query_plan(query):
+    # the details of sqlite's plan for query
+    compiled = query.statement.compile(db.engine)
+    params = [compiled.params[name] for name in compiled.positiontup]
+    rows = db.engine.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+    return ' '.join(row[-1] for row in rows)
+
+
+def test_query_plans(client):
+    # the hot filters are index searches, not table scans
+    queries = [
+        (Actor.query.filter_by(gender='male')
+         .filter(Actor.age <= 30, Actor.age >= 20), 'ix_actor_gender_age'),
+        (Role.query.filter_by(gender='male')
+         .filter(Role.age <= 30, Role.age >= 20), 'ix_role_gender_age'),
+        (Role.query.filter_by(gender='male', filled=True)
+         .filter(Role.age <= 30, Role.age >= 20), 'ix_role_'),
+        (Role.query.filter_by(movie_id=1), 'ix_role_movie_id'),
+        (Movie.query.filter(Movie.release_date > '2020-10-10'),
+         'ix_movie_release_date'),
+        (Actor.query.filter_by(id=1).join(Actor.bookings),
+         'ix_booking_actor_id'),
+        (filter_release_dates(Role.query, '2020-10-10', '2020-12-30'),
+         'ix_movie_release_date'),
+    ]
+    for query, index in queries:
+        plan = query_plan(query)
+        assert 'USING INDEX ' + index in plan or \
+            'USING COVERING INDEX ' + index in plan, plan
+
+
+def test_encoders():
+    data = {
+        'b': [1, 2.5, None, True],
+        'a': 'abc',
+        'date': Movie.query.first().release_date
+    }
+    assert StdlibEncoder().dumps(data) == OrjsonEncoder().dumps(data)
+
+
+def test_streamed_pages(client, monkeypatch):
+    # streamed pages read the same as buffered ones
+    # -------------------------------------------------
+    monkeypatch.setitem(client.application.extensions, 'response_cache', None)
+    url = '/roles'
+    nroles = Role.query.count()
+    for query_string in [{'page_length': 3}, {'page_length': 3, 'page': 2},
+                         {'page_length': nroles},
+                         {'page_length': 3, 'after': ''}]:
+        buffered = client.get(url, query_string=query_string)
+        monkeypatch.setitem(client.application.config,
+                            'STREAM_THRESHOLD', 2)
+        streamed = client.get(url, query_string=query_string)
+        monkeypatch.delitem(client.application.config, 'STREAM_THRESHOLD')
+        assert 'Content-Length' in buffered.headers
+        assert 'Content-Length' not in streamed.headers
+        assert streamed.json == buffered.json
+
+    # fail with 404 page out of bounds
+    # -------------------------------------------------
+    monkeypatch.setitem(client.application.config, 'STREAM_THRESHOLD', 2)
+    query_string = {'page_length': 3, 'page': BAD_PAGE}
+    response = client.get(url, query_string=query_string)
+    assert response.status_code == 404
+
+
+def test_response_cache(client):
+    # repeated reads come from the cache
+    # -------------------------------------------------
+    url = '/actors'
+    query_string = {'gender': 'female', 'page_length': 50}
+    first = client.get(url, query_string=query_string)
+    with count_queries() as statements:
+        # argument order doesn't matter
+        second = client.get(url, query_string=dict(
+            reversed(list(query_string.items()))))
+    assert statements == []
+    assert second.json == first.json
+
+    # writes invalidate
+    # -------------------------------------------------
+    response = client.post('/actor', json={
+        'name': 'Cachebuster', 'age': 40, 'gender': 'female'})
+    assert response.status_code == 200
+    response = client.get(url, query_string=query_string)
+    names = [a['name'] for a in response.json['actors']]
+    assert 'Cachebuster' in names
+
+    # so do deletes cascading from another table
+    movie_id = Movie.query.first().id
+    response = client.get(f'/movie/{movie_id}')
+    assert response.json['roles']
+    client.delete(f'/movie/{movie_id}')
+    response = client.get(f'/movie/{movie_id}')
+    assert response.status_code == 404
+
+
+def test_conditional_get(client):
+    # success
+    # -------------------------------------------------
+    url = '/roles'
+    query_string = {'filled': 'false'}
+    response = client.get(url, query_string=query_string)
+    etag = response.headers['ETag']
+    assert response.status_code == 200
+
+    headers = {'If-None-Match': etag}
+    with count_queries() as statements:
+        response = client.get(url, query_string=query_string,
+                              headers=headers)
+    assert response.status_code == 304
+    assert statements == []
+
+    # a different query has its own tag
+    response = client.get(url, query_string={'filled': 'true'},
+                          headers=headers)
+    assert response.status_code == 200
+
+    # writes change the tag
+    # -------------------------------------------------
+    role = Role.query.first()
+    client.patch(f'/role/{role.id}', json={'name': 'Retagged'})
+    response = client.get(url, query_string=query_string, headers=headers)
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_shared_versions(client):
+    # another worker's writes invalidate through a shared store
+    # -------------------------------------------------
+    url = '/actors'
+    query_string = {'gender': 'non', 'page_length': 50}
+    response = client.get(url, query_string=query_string)
+    etag = response.headers['ETag']
+    other_worker = TableVersions(versions.store)
+    db.session.add(Actor(name='Elsewhere', age=50, gender='non'))
+    db.session.commit()
+    other_worker.touch(Actor)
+    response = client.get(url, query_string=query_string,
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert 'Elsewhere' in [a['name'] for a in response.json['actors']]
+
+    # but not through a store of its own
+    worker_a, worker_b = TableVersions(), TableVersions()
+    before = worker_a.current(Actor)
+    worker_b.touch(Actor)
+    assert worker_a.current(Actor) == before
+
+    # so without a VERSION_STORE there is no caching and no ETag
+    # -------------------------------------------------
+    app = Flask(__name__)
+    setup_cache(app)
+    assert app.extensions['response_cache'] is None
+    calls = []
+
+    @cached(Actor)
+    def view():
+        calls.append(1)
+        return jsonify({'success': True})
+
+    with app.test_request_context(headers={'If-None-Match': etag}):
+        assert view().headers.get('ETag') is None
+        view()
+    assert len(calls) == 2
+
+    # each app keeps its own versions
+    # -------------------------------------------------
+    store = client.application.extensions['versions'].store
+    app.extensions['versions'] = TableVersions()
+    with app.app_context():
+        before = client.application.extensions['versions'].current(Actor)
+        versions.touch(Actor)
+    assert client.application.extensions['versions'].store is store
+    assert client.application.extensions['versions'].current(Actor) == \
+        before
+
+
+def test_pool_stats(client, tmp_path):
+    config = {'DB_POOL_SIZE': '3', 'DB_MAX_OVERFLOW': 2,
+              'DB_POOL_PRE_PING': 'true'}
+    stats = PoolStats()
+    # sqlite manages its own pool
+    assert engine_options(config, 'sqlite://', stats) == \
+        {'pool_pre_ping': True}
+
+    dburl = f'sqlite:///{tmp_path}/pool.db'
+    options = engine_options(config, 'postgresql://localhost/db', stats)
+    assert options['pool_size'] == 3 and options['max_overflow'] == 2
+    engine = create_engine(dburl, **options)
+    with engine.connect():
+        status = pool_status(engine.pool, stats)
+        assert status['checked_out'] == 1
+        assert status['size'] == 3
+    status = pool_status(engine.pool, stats)
+    assert status['checked_out'] == 0
+    assert status['checkouts'] == 1
+    assert sum(b['count'] for b in status['wait_histogram']) == 1
+
+    # without POOL_STATS only the token cache stats are served
+    assert client.get('/_internal/pool').status_code == 404
+    response = client.get('/_internal/token_cache')
+    assert response.status_code == 200
+    assert 'hits' in response.json
+
+
 def test_post_actor(client):
     # success
     # -------------------------------------------------
@@ -276,6 +609,58 @@ def test_post_movie(client):
     assert response.status_code == 422
 
 
+def test_post_bulk(client):
+    # success with per row errors
+    # -------------------------------------------------
+    url = '/actors/bulk'
+    nactors = Actor.query.count()
+    json = [
+        {'name': 'Bulk A', 'age': 30, 'gender': 'Male'},
+        {'name': 'Bulk B', 'age': 'N/A', 'gender': 'male'},  # age bad
+        {'name': 'Bulk C', 'gender': 'female'},  # age missing
+        {'name': 'Bulk D', 'age': 41, 'gender': 'non'},
+        {'name': 'Bulk G', 'age': [1], 'gender': 'non'},  # age not a scalar
+        {'name': 'Bulk H', 'age': {}, 'gender': 'non'}
+    ]
+    response = client.post(url, json=json)
+    assert response.status_code == 200
+    assert response.json['inserted'] == 2
+    assert [e['index'] for e in response.json['errors']] == [1, 2, 4, 5]
+    assert Actor.query.count() == nactors + 2
+    # the validators ran
+    assert Actor.query.filter_by(name='Bulk A').one().gender == 'male'
+
+    # ndjson
+    data = '\n'.join([
+        '{"name": "Bulk E", "age": 22, "gender": "female"}',
+        'not json',
+        '{"name": "Bulk F", "age": 23, "gender": "female"}',
+        ''
+    ])
+    response = client.post(url, data=data,
+                           content_type='application/x-ndjson')
+    assert response.status_code == 200
+    assert response.json['inserted'] == 2
+    assert [e['index'] for e in response.json['errors']] == [1]
+
+    # a row the database rejects doesn't sink the batch
+    url = '/movies/bulk'
+    json = [
+        {'title': 'Bulk Movie', 'release_date': 'Jan 1 2022'},
+        {'title': 'Bad Date', 'release_date': 'twenty seventh'}
+    ]
+    response = client.post(url, json=json)
+    assert response.status_code == 200
+    assert response.json['inserted'] == 1
+    assert [e['index'] for e in response.json['errors']] == [1]
+    assert Movie.query.filter_by(title='Bulk Movie').one_or_none()
+
+    # fail with 422 not an array
+    # -------------------------------------------------
+    response = client.post(url, json={'title': 'Bulk Movie'})
+    assert response.status_code == 422
+
+
 def test_delete_actor(client):
     # success
     # -------------------------------------------------
@@ -341,6 +726,22 @@ def test_patch_actor(client):
     assert response.status_code == 422
 
 
+def test_patch_statements(client):
+    # the update goes out before anything is read
+    actor_id = Actor.query.first().id
+    with count_queries() as statements:
+        response = client.patch(f'/actor/{actor_id}', json={'age': 33})
+    assert response.status_code == 200
+    assert response.json['actor']['age'] == 33
+    assert statements[0].startswith('UPDATE')
+    assert len(statements) <= 2
+
+    # nothing to update
+    response = client.patch(f'/actor/{actor_id}', json={'height': 180})
+    assert response.status_code == 200
+    assert response.json['actor']['age'] == 33
+
+
 def test_patch_movie(client):
     # success
     # -------------------------------------------------
@@ -391,6 +792,40 @@ def test_book_actor(client):
     assert response.status_code == 404
 
 
+def test_post_bookings(client):
+    # success with per pair conflicts
+    # -------------------------------------------------
+    url = '/bookings'
+    actor_id = Actor.query.first().id
+    open_roles = [r.id for r in Role.query.filter_by(filled=False).limit(2)]
+    filled_role = Role.query.filter_by(filled=True).first().id
+    json = [
+        {'actor_id': actor_id, 'role_id': open_roles[0]},
+        [actor_id, open_roles[1]],
+        [actor_id, filled_role],
+        [actor_id, open_roles[0]],  # already booked above
+        [BAD_ID, open_roles[1]],
+        [actor_id, BAD_ID]
+    ]
+    with count_queries() as statements:
+        response = client.post(url, json=json)
+    assert response.status_code == 200
+    # two lookups, one update and one insert
+    assert len([s for s in statements if s.startswith('SELECT')]) == 2
+    assert len(response.json['booked']) == 2
+    assert [c['index'] for c in response.json['conflicts']] == [2, 3, 4, 5]
+    assert all(Role.query.get(id_).filled for id_ in open_roles)
+    assert len(Actor.query.get(actor_id).bookings) >= 2
+
+    # fail with 422 malformed pairs
+    # -------------------------------------------------
+    response = client.post(url, json=[[actor_id]])
+    assert response.status_code == 422
+    # true would otherwise book id 1
+    response = client.post(url, json=[[True, open_roles[0]]])
+    assert response.status_code == 422
+
+
 def test_post_roles(client):
     # success
     # -------------------------------------------------
@@ -482,3 +917,321 @@ def test_patch_role(client):
     json = {'age': 'twenty_seven'}  # needs to be a number
     response = client.patch(url, json=json)
     assert response.status_code == 422
+
+
+def indexed(index, lower, upper):
+    # the non gendered actors index holds aged lower to upper
+    return sorted((r for r in index.rows.values()
+                   if r.gender == 'non' and lower <= r.age <= upper),
+                  key=lambda r: (r.age, r.id))
+
+
+def test_actor_index(client, monkeypatch):
+    app = client.application
+    monkeypatch.setitem(app.extensions, 'response_cache', None)
+    index = ActorIndex()
+    index.load()
+    monkeypatch.setitem(app.extensions['write_hooks'], Actor, [index.apply])
+
+    # writes through the models keep it current
+    # -------------------------------------------------
+    response = client.post('/actor', json={'name': 'Indexed', 'age': 300,
+                                           'gender': 'non'})
+    actor_id = response.json['actor']['id']
+    assert [r.id for r in indexed(index, 300, 300)] == [actor_id]
+    client.patch(f'/actor/{actor_id}', json={'age': 301})
+    assert indexed(index, 300, 300) == []
+    assert index.nearest('non', 305) == \
+        [(ActorRow(actor_id, 'Indexed', 301, 'non'), 4)]
+    client.post('/actors/bulk', json=[{'name': 'Indexed 2', 'age': 302,
+                                       'gender': 'non'}])
+    assert [r.name for r in indexed(index, 300, 310)] == \
+        ['Indexed', 'Indexed 2']
+    client.delete(f'/actor/{actor_id}')
+    assert [r.name for r in indexed(index, 300, 310)] == ['Indexed 2']
+    assert index.current()
+
+    # candidates match the query's
+    # -------------------------------------------------
+    movie_id = Role.query.first().movie_id
+    criteria = [Role.movie_id == movie_id]
+    assert index_candidates(index, criteria, 20) == \
+        group_candidates(candidate_query(criteria, 20))
+    url = f'/movie/{movie_id}/candidates?max_age_gap=20'
+    expected = client.get(url).json
+    monkeypatch.setitem(client.application.extensions, 'actor_index', index)
+    with count_queries() as statements:
+        assert client.get(url).json == expected
+    # the roles and the bookings, no scan of the actors
+    assert len(statements) == 2
+
+    # a write it didn't see rebuilds it
+    # -------------------------------------------------
+    versions.touch(Actor)
+    with client.application.app_context():
+        assert not index.current()
+    index.rebuilding.join()
+    assert index.current()
+
+    # and a local write after it doesn't hide it
+    db.session.add(Actor(name='Remote', age=400, gender='non'))
+    db.session.commit()
+    versions.touch(Actor)
+    client.post('/actor', json={'name': 'Local', 'age': 401,
+                                'gender': 'non'})
+    with client.application.app_context():
+        assert not index.current()
+    index.rebuilding.join()
+    assert [r.name for r in indexed(index, 400, 401)] == \
+        ['Remote', 'Local']
+    for row in indexed(index, 400, 401):
+        client.delete(f'/actor/{row.id}')
+
+    # candidates come from the database while it is stale
+    # -------------------------------------------------
+    role = Role.query.first()
+    bypass = Actor(name='Bypass', age=role.age, gender=role.gender)
+    db.session.add(bypass)
+    db.session.commit()
+    bypass_id, role_id = bypass.id, role.id
+    TableVersions(versions.store).touch(Actor)  # another worker
+    url = f'/role/{role_id}/candidates?limit=100'
+    with client.application.app_context():
+        assert not index.current()
+    response = client.get(url)
+    assert 'Bypass' in [c['actor']['name']
+                        for c in response.json['candidates']]
+    index.rebuilding.join()
+    client.delete(f'/actor/{bypass_id}')
+
+    # only on with shared versions
+    # -------------------------------------------------
+    bare = Flask(__name__)
+    bare.config.update(ACTOR_INDEX=True)
+    bare.extensions['shared_versions'] = False
+    setup_index(bare)
+    assert bare.extensions['actor_index'] is None
+
+
+def test_movie_roles(client):
+    response = client.post('/movie', json={'title': 'Extras',
+                                           'release_date': '2030-01-01'})
+    movie_id = response.json['movie']['id']
+    client.post(f'/roles/{movie_id}', json=[
+        {'name': 'Extra A', 'age': 20, 'gender': 'male'},
+        {'name': 'Extra B', 'age': 30, 'gender': 'female'},
+        {'name': 'Extra C', 'age': 40, 'gender': 'female'}
+    ])
+    roles = Role.query.filter_by(movie_id=movie_id).order_by(Role.id).all()
+    role_ids = [r.id for r in roles]
+    url = f'/movie/{movie_id}/roles'
+
+    # success, one UPDATE for the filtered roles
+    # -------------------------------------------------
+    with count_queries() as statements:
+        response = client.patch(url + '?gender=female', json={'age': 35})
+    assert response.status_code == 200
+    assert response.json['num_roles'] == 2
+    assert [r['id'] for r in response.json['roles']] == role_ids[1:]
+    assert all(r['age'] == 35 for r in response.json['roles'])
+    assert len([s for s in statements if s.startswith('UPDATE')]) == 1
+    assert Role.query.get(role_ids[0]).age == 20
+
+    # success with ids
+    # -------------------------------------------------
+    ids = f'{role_ids[0]},{role_ids[2]}'
+    response = client.patch(f'{url}?ids={ids}', json={'filled': True})
+    assert response.status_code == 200
+    assert [r['id'] for r in response.json['roles']] == \
+        [role_ids[0], role_ids[2]]
+    assert not Role.query.get(role_ids[1]).filled
+
+    # fail with 422 bad data or ids
+    # -------------------------------------------------
+    response = client.patch(url, json={'age': -1})
+    assert response.status_code == 422
+    response = client.patch(url, json={'height': 180})
+    assert response.status_code == 422
+    response = client.patch(url + '?ids=1,x', json={'age': 30})
+    assert response.status_code == 422
+
+    # fail with 404 movie not found
+    # -------------------------------------------------
+    response = client.patch(f'/movie/{BAD_ID}/roles', json={'age': 30})
+    assert response.status_code == 404
+    response = client.delete(f'/movie/{BAD_ID}/roles')
+    assert response.status_code == 404
+
+    # success deleting the filled roles
+    # -------------------------------------------------
+    response = client.delete(url + '?filled=true')
+    assert response.status_code == 200
+    assert [r['id'] for r in response.json['roles']] == \
+        [role_ids[0], role_ids[2]]
+    remaining = Role.query.filter_by(movie_id=movie_id).all()
+    assert [r.id for r in remaining] == [role_ids[1]]
+
+
+def test_candidates(client, monkeypatch):
+    monkeypatch.setitem(client.application.extensions, 'response_cache', None)
+    # ages no other actor in the test data has
+    actor_ids = {}
+    for age in [200, 203, 207]:
+        response = client.post('/actor', json={
+            'name': f'Candidate {age}', 'age': age, 'gender': 'non'})
+        actor_ids[age] = response.json['actor']['id']
+    response = client.post('/movie', json={'title': 'Casting',
+                                           'release_date': '2030-01-01'})
+    movie_id = response.json['movie']['id']
+    client.post(f'/roles/{movie_id}', json=[
+        {'name': 'Elder', 'age': 204, 'gender': 'non'},
+        {'name': 'Ancient', 'age': 500, 'gender': 'non'},
+        {'name': 'Booked', 'age': 205, 'gender': 'non'}
+    ])
+    elder, ancient, booked = [
+        r.id for r in Role.query.filter_by(movie_id=movie_id)
+        .order_by(Role.id)]
+    client.post(f'/actor/{actor_ids[203]}/role/{booked}')
+
+    # success, unfilled roles ranked by age gap in one query
+    # -------------------------------------------------
+    url = f'/movie/{movie_id}/candidates'
+    with count_queries() as statements:
+        response = client.get(url)
+    assert response.status_code == 200
+    assert len(statements) == 1
+    roles = response.json['roles']
+    assert [r['role']['id'] for r in roles] == [elder, ancient]
+    # the actor booked in the movie is left out
+    assert [(c['actor']['id'], c['age_gap'])
+            for c in roles[0]['candidates']] == \
+        [(actor_ids[207], 3), (actor_ids[200], 4)]
+    assert roles[1]['candidates'] == []
+
+    response = client.get(url + '?limit=1')
+    assert len(response.json['roles'][0]['candidates']) == 1
+    response = client.get(url + '?max_age_gap=3')
+    assert [c['actor']['id'] for c in
+            response.json['roles'][0]['candidates']] == [actor_ids[207]]
+
+    response = client.get(f'/role/{booked}/candidates')
+    assert response.status_code == 200
+    assert response.json['role']['id'] == booked
+    assert [c['actor']['id'] for c in response.json['candidates']] == \
+        [actor_ids[207], actor_ids[200]]
+
+    # fail with 422 bad args
+    # -------------------------------------------------
+    response = client.get(url + '?limit=0')
+    assert response.status_code == 422
+    response = client.get(url + '?max_age_gap=-1')
+    assert response.status_code == 422
+
+    # fail with 404 movie or role not found
+    # -------------------------------------------------
+    response = client.get(f'/movie/{BAD_ID}/candidates')
+    assert response.status_code == 404
+    response = client.get(f'/role/{BAD_ID}/candidates')
+    assert response.status_code == 404
+
+
+def test_assign_by_age():
+    # closest ages without crossing
+    assert assign_by_age([20, 30, 40], [(21, 1), (29, 1), (45, 1)]) == \
+        [21, 29, 45]
+    # two actors of one age
+    assert assign_by_age([20, 21, 50], [(20, 2), (40, 1)]) == [20, 20, 40]
+    # filling more roles beats a smaller gap
+    assert assign_by_age([10, 30], [(20, 1), (31, 1)]) == [20, 31]
+    # fewer actors than roles
+    assert assign_by_age([10, 30, 50], [(29, 1)]) == [None, 29, None]
+    # nobody within the gap
+    assert assign_by_age([10, 30], [(20, 1), (31, 1)], 5) == [None, 31]
+    assert assign_by_age([], [(20, 1)]) == []
+    assert assign_by_age([20], []) == [None]
+
+
+def test_autocast(client):
+    # ages no other actor in the test data has
+    actor_ids = {}
+    for age in [400, 402, 404, 410]:
+        response = client.post('/actor', json={
+            'name': f'Autocast {age}', 'age': age, 'gender': 'non'})
+        actor_ids[age] = response.json['actor']['id']
+    response = client.post('/movie', json={'title': 'Autocast',
+                                           'release_date': '2030-01-01'})
+    movie_id = response.json['movie']['id']
+    client.post(f'/roles/{movie_id}', json=[
+        {'name': f'Part {age}', 'age': age, 'gender': 'non'}
+        for age in [401, 405, 409, 420, 403]
+    ])
+    role_ids = {r.age: r.id for r in Role.query.filter_by(movie_id=movie_id)}
+    client.post(f'/actor/{actor_ids[404]}/role/{role_ids[403]}')
+    url = f'/movie/{movie_id}/autocast'
+
+    # success, a dry run books nothing
+    # -------------------------------------------------
+    with count_queries() as statements:
+        response = client.post(url, json={'max_age_gap': 20})
+    assert response.status_code == 200
+    assert len(statements) <= 4
+    # three actors for four roles, the one booked in the movie left out
+    expected = [
+        {'actor_id': actor_ids[400], 'role_id': role_ids[401], 'age_gap': 1},
+        {'actor_id': actor_ids[402], 'role_id': role_ids[405], 'age_gap': 3},
+        {'actor_id': actor_ids[410], 'role_id': role_ids[409], 'age_gap': 1}
+    ]
+    assert response.json['bookings'] == expected
+    assert response.json['total_age_gap'] == 5
+    assert response.json['unfilled'] == [role_ids[420]]
+    assert not response.json['committed']
+    assert Booking.query.filter_by(role_id=role_ids[401]).count() == 0
+
+    # success committing the bookings
+    # -------------------------------------------------
+    response = client.post(url, json={'max_age_gap': 20, 'commit': True})
+    assert response.status_code == 200
+    assert response.json['bookings'] == expected
+    assert response.json['committed']
+    for booking in expected:
+        assert Booking.query.filter_by(**{
+            k: booking[k] for k in ['actor_id', 'role_id']}).count() == 1
+        assert Role.query.get(booking['role_id']).filled
+    response = client.post(url, json={'max_age_gap': 20})
+    assert response.json['bookings'] == []
+    assert response.json['unfilled'] == [role_ids[420]]
+
+    # fail with 422 bad options
+    # -------------------------------------------------
+    response = client.post(url, json={'max_age_gap': -1})
+    assert response.status_code == 422
+    response = client.post(url, json={'max_age_gap': True})
+    assert response.status_code == 422
+    response = client.post(url, json={'commit': 'yes'})
+    assert response.status_code == 422
+
+    # fail with 404 movie not found
+    # -------------------------------------------------
+    response = client.post(f'/movie/{BAD_ID}/autocast')
+    assert response.status_code == 404
+
+
+def test_delete_cascades(client):
+    # the database removes the roles and their bookings
+    role = Role.query.first()
+    movie_id = role.movie_id
+    Booking.book_all([(Actor.query.first().id, role.id)])
+    role_ids = [r.id for r in Role.query.filter_by(movie_id=movie_id)]
+    with count_queries() as statements:
+        response = client.delete(f'/movie/{movie_id}')
+    assert response.status_code == 200
+    assert response.json['movie']['id'] == movie_id
+    assert len([s for s in statements if s.startswith('DELETE')]) == 1
+    assert len(statements) <= 2
+    assert Role.query.filter_by(movie_id=movie_id).count() == 0
+    assert Booking.query.filter(Booking.role_id.in_(role_ids)).count() == 0
+
+    # only the app's engine is told to enforce foreign keys
+    assert db.session.execute('PRAGMA foreign_keys').scalar() == 1
+    assert create_engine('sqlite://').execute(
+        'PRAGMA foreign_keys').scalar() == 0
@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# generous so slow machines pass, about three times what it takes now
+IMPORT_BUDGET = 1.5  # seconds
+# only needed once a token is checked
+LAZY_MODULES = ['jose', 'ecdsa']
+
+
+def import_times(module):
+    # {module: cumulative seconds} from python -X importtime
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def test_flaskr_import_time():
+    times = import_times('flaskr')
+    assert times['flaskr'] < IMPORT_BUDGET
+    for module in LAZY_MODULES:
+        assert module not in times, f'{module} imported with flaskr'